@@ -3,9 +3,14 @@ from uuid import UUID
 import base64
 
 from fastapi import APIRouter, Depends, HTTPException, status, Path, Body
+from sqlalchemy.ext.asyncio import AsyncSession
 
-from auth import get_admin_user, get_password_hash
+from auth import get_admin_user, get_password_hash, crypto_pool, CryptoPoolFull
+from database import get_session, get_read_session
 from repositories import DeviceRepository, UserRepository
+from repositories.identity_cache import device_cache, user_cache, public_key_cache
+from repositories.device_state import device_state
+from realtime import connection_manager, schedule_notifier
 from schemas import DeviceInDB, UserInDB, CreateUser, CreateDevice, RegisterDevice
 from models import User, Device
 
@@ -16,14 +21,15 @@ admin_router = APIRouter(
 
 @admin_router.post("/device")
 async def create_device(
-    new_device: Annotated[CreateDevice, Body(title="New device data")]
+    new_device: Annotated[CreateDevice, Body(title="New device data")],
+    session: Annotated[AsyncSession, Depends(get_session)],
 ):
     try:
         device = Device(
             device_id=new_device.device_id,
             public_key=base64.b64decode(new_device.public_key_b64).decode(),
         )
-        await DeviceRepository.create_device(device)
+        await DeviceRepository.create_device(device, session)
     except ValueError as e:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
     except Exception as e:
@@ -33,9 +39,11 @@ async def create_device(
 
 
 @admin_router.get("/device")
-async def get_all_devices():
+async def get_all_devices(
+    read_session: Annotated[AsyncSession, Depends(get_read_session)],
+):
     try:
-        return await DeviceRepository.get_all_devices()
+        return await DeviceRepository.get_all_devices(read_session)
     except Exception as e:
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e)
@@ -43,9 +51,12 @@ async def get_all_devices():
 
 
 @admin_router.get("/device/{device_id}")
-async def get_device(device_id: Annotated[UUID, Path(title="ID of device to get")]):
+async def get_device(
+    device_id: Annotated[UUID, Path(title="ID of device to get")],
+    session: Annotated[AsyncSession, Depends(get_session)],
+):
     try:
-        return await DeviceRepository.get_device_by_id(device_id)
+        return await DeviceRepository.get_device_by_id(device_id, session)
     except ValueError as e:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=str(e))
     except Exception as e:
@@ -58,9 +69,10 @@ async def get_device(device_id: Annotated[UUID, Path(title="ID of device to get"
 async def update_device(
     device_id: Annotated[UUID, Path(title="ID of device to update")],
     device: Annotated[DeviceInDB, Body(title="Updated device data")],
+    session: Annotated[AsyncSession, Depends(get_session)],
 ):
     try:
-        await DeviceRepository.update_device(device_id, device)
+        await DeviceRepository.update_device(device_id, device, session)
     except ValueError as e:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=str(e))
     except Exception as e:
@@ -71,10 +83,11 @@ async def update_device(
 
 @admin_router.delete("/device/{device_id}")
 async def delete_device(
-    device_id: Annotated[UUID, Path(title="ID of device to delete")]
+    device_id: Annotated[UUID, Path(title="ID of device to delete")],
+    session: Annotated[AsyncSession, Depends(get_session)],
 ):
     try:
-        await DeviceRepository.delete_device_by_id(device_id)
+        await DeviceRepository.delete_device_by_id(device_id, session)
     except ValueError as e:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=str(e))
     except Exception as e:
@@ -85,11 +98,12 @@ async def delete_device(
 
 @admin_router.post("/device/register")
 async def register_device(
-    register_data: Annotated[RegisterDevice, Body(title="Data to register a device")]
+    register_data: Annotated[RegisterDevice, Body(title="Data to register a device")],
+    session: Annotated[AsyncSession, Depends(get_session)],
 ):
     try:
         await DeviceRepository.register_device(
-            register_data.device_id, register_data.user_id
+            register_data.device_id, register_data.user_id, session
         )
     except ValueError as e:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
@@ -101,10 +115,11 @@ async def register_device(
 
 @admin_router.delete("/device/unregister")
 async def unregister_device(
-    device_id: Annotated[RegisterDevice, Body(title="Data to unregister a device")]
+    device_id: Annotated[RegisterDevice, Body(title="Data to unregister a device")],
+    session: Annotated[AsyncSession, Depends(get_session)],
 ):
     try:
-        await DeviceRepository.unregister_device(device_id.device_id)
+        await DeviceRepository.unregister_device(device_id.device_id, session)
     except ValueError as e:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
     except Exception as e:
@@ -114,16 +129,23 @@ async def unregister_device(
 
 
 @admin_router.post("/user")
-async def create_user(new_user: Annotated[CreateUser, Body(title="New user data")]):
+async def create_user(
+    new_user: Annotated[CreateUser, Body(title="New user data")],
+    session: Annotated[AsyncSession, Depends(get_session)],
+):
     try:
         user = User(
             email=new_user.email,
-            hashed_password=get_password_hash(new_user.password),
+            hashed_password=await crypto_pool.run(get_password_hash, new_user.password),
             is_admin=new_user.is_admin,
         )
-        await UserRepository.create_user(user)
+        await UserRepository.create_user(user, session)
     except ValueError as e:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+    except CryptoPoolFull as e:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail=str(e)
+        )
     except Exception as e:
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e)
@@ -131,9 +153,11 @@ async def create_user(new_user: Annotated[CreateUser, Body(title="New user data"
 
 
 @admin_router.get("/user")
-async def get_all_users():
+async def get_all_users(
+    read_session: Annotated[AsyncSession, Depends(get_read_session)],
+):
     try:
-        return await UserRepository.get_all_users()
+        return await UserRepository.get_all_users(read_session)
     except Exception as e:
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e)
@@ -141,9 +165,12 @@ async def get_all_users():
 
 
 @admin_router.get("/user/{user_id}")
-async def get_user(user_id: Annotated[UUID, Path(title="ID of user to get")]):
+async def get_user(
+    user_id: Annotated[UUID, Path(title="ID of user to get")],
+    session: Annotated[AsyncSession, Depends(get_session)],
+):
     try:
-        return await UserRepository.get_user_by_id(user_id)
+        return await UserRepository.get_user_by_id(user_id, session)
     except ValueError as e:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=str(e))
     except Exception as e:
@@ -168,12 +195,35 @@ async def update_user(
 
 
 @admin_router.delete("/user/{user_id}")
-async def delete_user(user_id: Annotated[UUID, Path(title="ID of user to delete")]):
+async def delete_user(
+    user_id: Annotated[UUID, Path(title="ID of user to delete")],
+    session: Annotated[AsyncSession, Depends(get_session)],
+):
     try:
-        UserRepository.delete_user_by_id(user_id)
+        await UserRepository.delete_user_by_id(user_id, session)
     except ValueError as e:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=str(e))
     except Exception as e:
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e)
         )
+
+
+@admin_router.get("/cache")
+async def get_cache_stats():
+    return {
+        "device": device_cache.stats(),
+        "user": user_cache.stats(),
+        "public_key": public_key_cache.stats(),
+        "device_state": device_state.stats(),
+    }
+
+
+@admin_router.get("/crypto-pool")
+async def get_crypto_pool_stats():
+    return crypto_pool.stats()
+
+
+@admin_router.get("/connections")
+async def get_connection_stats():
+    return {**connection_manager.stats(), "schedule": schedule_notifier.stats()}
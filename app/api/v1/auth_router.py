@@ -1,16 +1,23 @@
-from datetime import datetime, timedelta
+from datetime import timedelta
 from typing import Annotated
-from uuid import UUID, uuid4
+from uuid import UUID
 from dotenv import load_dotenv
 import os
 
 from fastapi import APIRouter, HTTPException, Depends, status
 from fastapi.security import OAuth2PasswordRequestForm
+from sqlalchemy.ext.asyncio import AsyncSession
 
-from models import Device, Challenge
+from database import get_session
+from models import Challenge
 from schemas import Token, AuthChallenge, AuthRequest
-from repositories import DeviceRepository, ChallengeRepository
-from auth import authenticate_user, authenticate_device, create_access_token
+from repositories.challenge_store import challenge_store
+from auth import (
+    authenticate_user,
+    authenticate_device,
+    create_access_token,
+    CryptoPoolFull,
+)
 
 load_dotenv("")
 JWT_EXPIRE_MINUTES = int(os.getenv("JWT_LENGTH_MINUTES"))
@@ -20,9 +27,17 @@ auth_router = APIRouter()
 
 @auth_router.post("/user/login")
 async def user_login(
-    form_data: Annotated[OAuth2PasswordRequestForm, Depends()]
+    form_data: Annotated[OAuth2PasswordRequestForm, Depends()],
+    session: Annotated[AsyncSession, Depends(get_session)],
 ) -> Token:
-    user = await authenticate_user(form_data.username, form_data.password)
+    try:
+        user = await authenticate_user(form_data.username, form_data.password, session)
+    except CryptoPoolFull as e:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail=str(e),
+            headers={"Retry-After": "1"},
+        )
     if not user:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -39,15 +54,24 @@ async def user_login(
 
 
 @auth_router.post("/device/login")
-async def device_login(auth_request: AuthRequest):
+async def device_login(
+    auth_request: AuthRequest,
+    session: Annotated[AsyncSession, Depends(get_session)],
+):
     try:
-        device = await authenticate_device(auth_request)
+        device = await authenticate_device(auth_request, session)
     except ValueError as e:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail=str(e),
             headers={"WWW-Authenticate": "Bearer"},
         )
+    except CryptoPoolFull as e:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail=str(e),
+            headers={"Retry-After": "1"},
+        )
 
     access_token_expires = timedelta(minutes=JWT_EXPIRE_MINUTES)
     access_token = create_access_token(
@@ -58,22 +82,11 @@ async def device_login(auth_request: AuthRequest):
 
 
 @auth_router.get("/device/challenge/{device_id}")
-async def get_challenge(device_id: UUID):
-    device: Device = await DeviceRepository.get_device_by_id(device_id)
-    if not device:
+async def get_challenge(
+    device_id: UUID,
+    session: Annotated[AsyncSession, Depends(get_session)],
+):
+    challenge_info: Challenge = await challenge_store.issue(device_id, session)
+    if challenge_info is None:
         raise HTTPException(status_code=404, detail="Device not found")
-
-    challenge_info: Challenge = await ChallengeRepository.get_challenge(device_id)
-    if challenge_info:
-        if challenge_info.expires_at > datetime.now():
-            return AuthChallenge(
-                challenge=challenge_info.challenge, device_id=device_id
-            )
-        else:
-            await ChallengeRepository.delete_challenge(device_id)
-
-    challenge = uuid4().hex
-    expires_at = datetime.now() + timedelta(minutes=5)
-    await ChallengeRepository.create_challenge(device_id, challenge, expires_at)
-
-    return AuthChallenge(challenge=challenge, device_id=device_id)
+    return AuthChallenge(challenge=challenge_info.challenge, device_id=device_id)
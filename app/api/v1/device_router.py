@@ -1,37 +1,134 @@
-from typing import Annotated
+from datetime import datetime, timezone
+from typing import Annotated, Any
+import asyncio
+import json
+import logging
 
-from fastapi import APIRouter, HTTPException, status, Depends, Path, Body
+from fastapi import (
+    APIRouter,
+    HTTPException,
+    status,
+    Depends,
+    Path,
+    Body,
+    WebSocket,
+    WebSocketDisconnect,
+    WebSocketException,
+    Query,
+    Header,
+    Response,
+)
+from pydantic import ValidationError
+from sqlalchemy.ext.asyncio import AsyncSession
 
-from auth import get_device_from_token
-from schemas import DeviceInDB, ThermostatReport
+from auth import get_device_from_token, load_device_from_token
+from database import get_session, get_read_session
+from schemas import DeviceInDB, ThermostatReport, ReportResult, ReportBatchResult
 from models import Report
 from repositories import DeviceRepository, ReportRepository
-from api.v1.user_router import connection_manager
+from repositories.device_state import device_state
+from realtime import connection_manager, schedule_notifier
+from api.v1.responses import schedule_response
+
+logger = logging.getLogger(__name__)
+
+MAX_REPORT_BATCH = 1000
+MAX_SCHEDULE_WAIT_S = 60
 
 device_router = APIRouter(
     dependencies=[Depends(get_device_from_token)],
 )
 
+# websocket routes cannot use the bearer dependency of device_router,
+# the token is checked by the endpoint itself
+device_socket_router = APIRouter()
+
+
+async def _store_report(
+    device: DeviceInDB,
+    report_data: ThermostatReport,
+    session: AsyncSession | None = None,
+):
+    report = Report(
+        user_id=device.user_id,
+        device_id=device.device_id,
+        temperature_celcius=report_data.temperature_celcius,
+        heater_on=report_data.heater_on,
+        timestamp=report_data.timestamp,
+    )
+    await ReportRepository.create_report(report, session)
+    device_state.update(
+        device.device_id,
+        report_data.temperature_celcius,
+        report_data.heater_on,
+        report_data.timestamp,
+    )
+    connection_manager.publish(device.device_id, report_data.model_dump_json())
+
 
 @device_router.get("/schedule")
 async def get_device_schedule(
-    current_device: Annotated[DeviceInDB, Depends(get_device_from_token)]
+    current_device: Annotated[DeviceInDB, Depends(get_device_from_token)],
+    session: Annotated[AsyncSession, Depends(get_session)],
+    read_session: Annotated[AsyncSession, Depends(get_read_session)],
+    if_none_match: Annotated[str | None, Header()] = None,
+    version: Annotated[int | None, Query()] = None,
+    wait: Annotated[float, Query(ge=0, le=MAX_SCHEDULE_WAIT_S)] = 0,
 ):
+    """The device's schedule, ETag is its version
+
+    Long-poll with `version` and `wait`: the request is held until the
+    schedule version differs from `version` (answered with the schedule)
+    or `wait` seconds pass (304).
+    """
+    long_poll = version is not None and wait > 0
+    # subscribe before reading so a change in between is not missed
+    mailbox = (
+        schedule_notifier.subscribe(current_device.device_id) if long_poll else None
+    )
     try:
-        schedule = await DeviceRepository.get_device_schedule(current_device.device_id)
-        return schedule
-    except ValueError as e:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=str(e))
-    except Exception as e:
-        raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e)
-        )
+        try:
+            # long-polls read the primary, a lagging replica would look like a change
+            schedule_json, current = await DeviceRepository.get_device_schedule_version(
+                current_device.device_id, session if long_poll else read_session
+            )
+        except ValueError as e:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=str(e))
+        except Exception as e:
+            raise HTTPException(
+                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e)
+            )
+        if not long_poll or current != version:
+            return schedule_response(schedule_json, current, if_none_match)
+
+        # don't keep pool connections checked out while parked
+        await session.close()
+        await read_session.close()
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + wait
+        while (remaining := deadline - loop.time()) > 0:
+            try:
+                message = json.loads(await asyncio.wait_for(mailbox.get(), remaining))
+            except asyncio.TimeoutError:
+                break
+            if message["version"] != version:
+                schedule = message["schedule"]
+                return schedule_response(
+                    json.dumps(schedule) if schedule is not None else None,
+                    message["version"],
+                )
+        # nothing newer than `version` arrived: answer as a matching ETag
+        return schedule_response(None, version, f'"{version}"')
+    finally:
+        if mailbox is not None:
+            schedule_notifier.unsubscribe(current_device.device_id, mailbox)
 
 
 @device_router.post("/report")
 async def create_report(
     current_device: Annotated[DeviceInDB, Depends(get_device_from_token)],
     report_data: Annotated[ThermostatReport, Body(title="Report data")],
+    session: Annotated[AsyncSession, Depends(get_session)],
 ):
     try:
         if current_device.user_id is None:
@@ -40,20 +137,176 @@ async def create_report(
                 detail="Device is not registered to a user",
             )
 
-        report = Report(
-            user_id=current_device.user_id,
-            device_id=current_device.device_id,
-            temperature_celcius=report_data.temperature_celcius,
-            heater_on=report_data.heater_on,
-            timestamp=report_data.timestamp,
+        await _store_report(current_device, report_data, session)
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e)
         )
-        await ReportRepository.create_report(report)
-        await connection_manager.send_message(
-            current_device.device_id, report_data.model_dump_json()
+
+
+@device_router.post("/reports")
+async def create_reports(
+    current_device: Annotated[DeviceInDB, Depends(get_device_from_token)],
+    reports_data: Annotated[list[Any], Body(title="Batch of report data")],
+    session: Annotated[AsyncSession, Depends(get_session)],
+) -> ReportBatchResult:
+    if current_device.user_id is None:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Device is not registered to a user",
         )
+    if len(reports_data) > MAX_REPORT_BATCH:
+        raise HTTPException(
+            status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+            detail=f"Batch exceeds {MAX_REPORT_BATCH} reports",
+        )
+
+    results: list[ReportResult] = []
+    accepted: list[ThermostatReport] = []
+    for index, item in enumerate(reports_data):
+        try:
+            accepted.append(ThermostatReport.model_validate(item))
+            results.append(ReportResult(index=index, accepted=True))
+        except ValidationError as e:
+            results.append(
+                ReportResult(
+                    index=index,
+                    accepted=False,
+                    error="; ".join(err["msg"] for err in e.errors()),
+                )
+            )
+
+    try:
+        reports = [
+            Report(
+                user_id=current_device.user_id,
+                device_id=current_device.device_id,
+                temperature_celcius=report_data.temperature_celcius,
+                heater_on=report_data.heater_on,
+                timestamp=report_data.timestamp,
+            )
+            for report_data in accepted
+        ]
+        await ReportRepository.create_reports(reports, session)
+        if accepted:
+            latest = max(accepted, key=lambda report_data: report_data.timestamp)
+            device_state.update(
+                current_device.device_id,
+                latest.temperature_celcius,
+                latest.heater_on,
+                latest.timestamp,
+            )
+        for report_data in accepted:
+            connection_manager.publish(
+                current_device.device_id, report_data.model_dump_json()
+            )
     except ValueError as e:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
     except Exception as e:
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e)
         )
+
+    return ReportBatchResult(
+        accepted=len(accepted),
+        rejected=len(results) - len(accepted),
+        results=results,
+    )
+
+
+@device_socket_router.websocket("/ws")
+async def device_socket(websocket: WebSocket):
+    """Reports up, schedule pushes down, authenticated once per connection
+
+    The device token from /auth/device/login goes in an `Authorization:
+    Bearer` header or a `token` query parameter; the socket is closed when
+    that token expires. Each text frame is a report (same body as POST
+    /report) and is answered with an ack or an error; the server sends
+    `{"type": "schedule", ...}` on connect and on change.
+    """
+    token = websocket.query_params.get("token")
+    authorization = websocket.headers.get("authorization", "")
+    if authorization.lower().startswith("bearer "):
+        token = authorization[len("bearer ") :]
+    try:
+        if token is None:
+            raise ValueError("Missing token")
+        # no session: a socket lives far longer than a request session
+        device, expires_at = await load_device_from_token(token)
+    except ValueError:
+        raise WebSocketException(
+            code=status.WS_1008_POLICY_VIOLATION,
+            reason="Could not validate credentials",
+        )
+
+    await websocket.accept()
+    mailbox = schedule_notifier.subscribe(device.device_id)
+    send_lock = asyncio.Lock()
+
+    async def send(message: dict):
+        async with send_lock:
+            await websocket.send_json(message)
+
+    async def push_schedules():
+        schedule_json, version = await DeviceRepository.get_device_schedule_version(
+            device.device_id
+        )
+        await send(
+            {
+                "type": "schedule",
+                "version": version,
+                "schedule": json.loads(schedule_json) if schedule_json else None,
+            }
+        )
+        while True:
+            message = json.loads(await mailbox.get())
+            if message["version"] > version:
+                version = message["version"]
+                await send({"type": "schedule", **message})
+
+    async def receive_reports():
+        while True:
+            text = await websocket.receive_text()
+            try:
+                report_data = ThermostatReport.model_validate_json(text)
+            except ValidationError as e:
+                detail = "; ".join(err["msg"] for err in e.errors())
+                await send({"type": "error", "detail": detail})
+                continue
+            if device.user_id is None:
+                await send(
+                    {"type": "error", "detail": "Device is not registered to a user"}
+                )
+                continue
+            try:
+                await _store_report(device, report_data)
+            except Exception as e:
+                await send({"type": "error", "detail": str(e)})
+                continue
+            await send({"type": "ack", "timestamp": report_data.timestamp.isoformat()})
+
+    async def expire():
+        # also ends sockets that only ever receive schedule pushes
+        await asyncio.sleep((expires_at - datetime.now(timezone.utc)).total_seconds())
+        async with send_lock:
+            await websocket.close(
+                code=status.WS_1008_POLICY_VIOLATION, reason="Token expired"
+            )
+
+    tasks = [
+        asyncio.create_task(push_schedules()),
+        asyncio.create_task(receive_reports()),
+        asyncio.create_task(expire()),
+    ]
+    try:
+        done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            error = task.exception()
+            if error is not None and not isinstance(error, WebSocketDisconnect):
+                logger.error("Device socket failed", exc_info=error)
+    finally:
+        for task in tasks:
+            task.cancel()
+        schedule_notifier.unsubscribe(device.device_id, mailbox)
@@ -0,0 +1,27 @@
+from fastapi import Response, status
+
+
+def etag_matches(if_none_match: str | None, etag: str) -> bool:
+    if if_none_match is None:
+        return False
+    candidates = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+    return "*" in candidates or etag in candidates
+
+
+def schedule_response(
+    schedule_json: str | None, version: int, if_none_match: str | None = None
+) -> Response:
+    """Stored schedule JSON sent as is, tagged with its version
+
+    Schedules are validated when written, so they are neither parsed nor
+    re-serialized here; a matching If-None-Match gets an empty 304.
+    """
+    etag = f'"{version}"'
+    headers = {"ETag": etag, "Schedule-Version": str(version)}
+    if etag_matches(if_none_match, etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    return Response(
+        content=schedule_json or "null",
+        media_type="application/json",
+        headers=headers,
+    )
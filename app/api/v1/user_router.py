@@ -1,46 +1,146 @@
-from collections import defaultdict
 from datetime import datetime, timedelta
-from typing import Annotated, Optional
+from typing import Annotated, AsyncIterator, Literal, Optional
 from uuid import UUID
 import asyncio
+import base64
+import csv
+import io
+import zlib
 
-from fastapi import APIRouter, Depends, Path, Body, HTTPException, status, Request
+from fastapi import (
+    APIRouter,
+    Depends,
+    Path,
+    Body,
+    Query,
+    HTTPException,
+    status,
+    Request,
+    Header,
+)
+from fastapi.responses import StreamingResponse
 from sse_starlette.sse import EventSourceResponse
+from sqlalchemy.ext.asyncio import AsyncSession
 
 from auth import get_user_from_token
-from schemas import UserDevice, ThermostatSchedule, UserInDB, ThermostatReport
+from database import get_session, get_read_session
+from schemas import (
+    UserDevice,
+    ThermostatSchedule,
+    UserInDB,
+    ThermostatReport,
+    ReportInDB,
+    ReportPage,
+    ReportBucket,
+    DeviceLatest,
+)
 from repositories import DeviceRepository, ReportRepository
+from api.v1.responses import schedule_response
+from repositories.device_state import device_state
+from repositories.identity_cache import device_cache
+from realtime import (
+    connection_manager,
+    Overflow,
+    TooManyConnections,
+)
 
 user_router = APIRouter(
     dependencies=[Depends(get_user_from_token)],
 )
 
+DEFAULT_REPORT_PAGE = 500
+MAX_REPORT_PAGE = 5000
+
+
+def _encode_cursor(timestamp: datetime, report_id: UUID) -> str:
+    return base64.urlsafe_b64encode(
+        f"{timestamp.isoformat()}|{report_id}".encode()
+    ).decode()
+
+
+def _decode_cursor(cursor: str) -> tuple[datetime, UUID]:
+    try:
+        timestamp, report_id = base64.urlsafe_b64decode(cursor).decode().split("|")
+        return datetime.fromisoformat(timestamp), UUID(report_id)
+    except ValueError:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid cursor"
+        )
+
 
-# not a good place to put this but w/e
-class ConnectionManager:
-    def __init__(self):
-        self.active_connections = defaultdict(set)
+EXPORT_CHUNK_BYTES = 64 * 1024
+_EXPORT_COLUMNS = [
+    "report_id",
+    "user_id",
+    "device_id",
+    "timestamp",
+    "temperature_celcius",
+    "heater_on",
+]
 
-    async def connect(self, device_id: str, client: asyncio.Queue):
-        self.active_connections[device_id].add(client)
 
-    def disconnect(self, device_id: str, client: asyncio.Queue):
-        self.active_connections[device_id].remove(client)
+async def _ensure_user_device(
+    user: UserInDB, device_id: UUID, session: AsyncSession | None = None
+):
+    """404 unless the device belongs to the user"""
+    devices = await DeviceRepository.get_users_devices(user.user_id, session)
+    if device_id not in [device.device_id for device in devices]:
+        raise HTTPException(
+            status_code=404, detail="User does not have a device with that ID"
+        )
 
-    async def send_message(self, device_id: str, message: str):
-        for client in self.active_connections[device_id]:
-            await client.put(message)
 
+async def _export_chunks(
+    reports: AsyncIterator, format: str, gzip: bool
+) -> AsyncIterator[bytes]:
+    """Encode streamed reports as CSV or NDJSON, optionally gzipped, in ~64KiB chunks"""
+    compressor = zlib.compressobj(wbits=31) if gzip else None  # 31: gzip container
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    if format == "csv":
+        writer.writerow(_EXPORT_COLUMNS)
 
-connection_manager = ConnectionManager()
+    def flush() -> bytes:
+        data = buffer.getvalue().encode()
+        buffer.seek(0)
+        buffer.truncate()
+        return compressor.compress(data) if compressor else data
+
+    async for report in reports:
+        if format == "csv":
+            writer.writerow([getattr(report, column) for column in _EXPORT_COLUMNS])
+        else:
+            buffer.write(ReportInDB.model_validate(report).model_dump_json())
+            buffer.write("\n")
+        if buffer.tell() >= EXPORT_CHUNK_BYTES:
+            yield flush()
+    yield flush()
+    if compressor:
+        yield compressor.flush()
+
+
+def _export_response(
+    reports: AsyncIterator, format: str, gzip: bool, filename: str
+) -> StreamingResponse:
+    filename = f"{filename}.{format}"
+    media_type = "text/csv" if format == "csv" else "application/x-ndjson"
+    if gzip:
+        filename += ".gz"
+        media_type = "application/gzip"
+    return StreamingResponse(
+        _export_chunks(reports, format, gzip),
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+    )
 
 
 @user_router.get("/device")
 async def get_user_devices(
-    user: Annotated[UserInDB, Depends(get_user_from_token)]
+    user: Annotated[UserInDB, Depends(get_user_from_token)],
+    session: Annotated[AsyncSession, Depends(get_session)],
 ) -> list[UserDevice]:
     try:
-        devices = await DeviceRepository.get_users_devices(user.user_id)
+        devices = await DeviceRepository.get_users_devices(user.user_id, session)
         devices_to_return = []
         for device in devices:
             try:
@@ -64,9 +164,12 @@ async def get_user_devices(
 
 
 @user_router.get("/device/{device_id}")
-async def get_device(device_id: Annotated[UUID, Path(title="ID of device to get")]):
+async def get_device(
+    device_id: Annotated[UUID, Path(title="ID of device to get")],
+    session: Annotated[AsyncSession, Depends(get_session)],
+):
     try:
-        device = await DeviceRepository.get_device_by_id(device_id)
+        device = await DeviceRepository.get_device_by_id(device_id, session)
         try:
             schedule = ThermostatSchedule.model_validate_json(device.schedule)
         except:
@@ -84,10 +187,57 @@ async def get_device(device_id: Annotated[UUID, Path(title="ID of device to get"
         )
 
 
+@user_router.get("/device/{device_id}/latest")
+async def get_device_latest(
+    device_id: Annotated[UUID, Path],
+    user: Annotated[UserInDB, Depends(get_user_from_token)],
+    read_session: Annotated[AsyncSession, Depends(get_read_session)],
+) -> DeviceLatest:
+    try:
+        # ownership and state both come from memory once warm
+        device = device_cache.get(device_id)
+        if device is None:
+            device = await DeviceRepository.get_device_by_id(device_id, read_session)
+            device_cache.put(device_id, device)
+        if device.user_id != user.user_id:
+            raise ValueError("User does not have a device with that ID")
+        state = await device_state.get(device_id, read_session)
+    except ValueError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e)
+        )
+    if state is None:
+        raise HTTPException(status_code=404, detail="Device has not reported yet")
+    return DeviceLatest.model_validate(state)
+
+
 @user_router.get("/device/{device_id}/reports")
-async def get_device_reports(device_id: Annotated[UUID, Path]):
+async def get_device_reports(
+    device_id: Annotated[UUID, Path],
+    user: Annotated[UserInDB, Depends(get_user_from_token)],
+    read_session: Annotated[AsyncSession, Depends(get_read_session)],
+    from_time: Annotated[datetime | None, Query(alias="from")] = None,
+    to_time: Annotated[datetime | None, Query(alias="to")] = None,
+    limit: Annotated[int, Query(ge=1, le=MAX_REPORT_PAGE)] = DEFAULT_REPORT_PAGE,
+    cursor: Annotated[str | None, Query()] = None,
+) -> ReportPage:
+    await _ensure_user_device(user, device_id, read_session)
+    after = _decode_cursor(cursor) if cursor is not None else None
     try:
-        return await ReportRepository.get_device_reports(device_id)
+        # one extra row tells whether there is a next page
+        reports = await ReportRepository.get_device_reports(
+            device_id, read_session, from_time, to_time, after, limit + 1
+        )
+        next_cursor = None
+        if len(reports) > limit:
+            reports = reports[:limit]
+            next_cursor = _encode_cursor(reports[-1].timestamp, reports[-1].report_id)
+        return ReportPage(
+            reports=[ReportInDB.model_validate(report) for report in reports],
+            next_cursor=next_cursor,
+        )
     except ValueError as e:
         raise HTTPException(status_code=404, detail=str(e))
     except Exception as e:
@@ -96,45 +246,124 @@ async def get_device_reports(device_id: Annotated[UUID, Path]):
         )
 
 
+@user_router.get("/device/{device_id}/reports/aggregate")
+async def get_device_report_aggregates(
+    device_id: Annotated[UUID, Path],
+    user: Annotated[UserInDB, Depends(get_user_from_token)],
+    bucket: Annotated[Literal["5m", "1h", "1d"], Query()],
+    read_session: Annotated[AsyncSession, Depends(get_read_session)],
+    from_time: Annotated[datetime | None, Query(alias="from")] = None,
+    to_time: Annotated[datetime | None, Query(alias="to")] = None,
+) -> list[ReportBucket]:
+    await _ensure_user_device(user, device_id, read_session)
+    try:
+        rows = await ReportRepository.aggregate_device_reports(
+            device_id, bucket, from_time, to_time, read_session
+        )
+        return [ReportBucket.model_validate(row, from_attributes=True) for row in rows]
+    except ValueError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e)
+        )
+
+
+@user_router.get("/device/{device_id}/reports/export")
+async def export_device_reports(
+    device_id: Annotated[UUID, Path],
+    user: Annotated[UserInDB, Depends(get_user_from_token)],
+    session: Annotated[AsyncSession, Depends(get_session)],
+    format: Annotated[Literal["csv", "ndjson"], Query()] = "csv",
+    gzip: Annotated[bool, Query()] = False,
+    from_time: Annotated[datetime | None, Query(alias="from")] = None,
+    to_time: Annotated[datetime | None, Query(alias="to")] = None,
+):
+    await _ensure_user_device(user, device_id, session)
+
+    # no session passed: the request session closes before streaming
+    reports = ReportRepository.stream_device_reports(device_id, from_time, to_time)
+    return _export_response(reports, format, gzip, f"reports-{device_id}")
+
+
+@user_router.get("/reports/export")
+async def export_user_reports(
+    user: Annotated[UserInDB, Depends(get_user_from_token)],
+    format: Annotated[Literal["csv", "ndjson"], Query()] = "csv",
+    gzip: Annotated[bool, Query()] = False,
+):
+    reports = ReportRepository.stream_user_reports(user.user_id)
+    return _export_response(reports, format, gzip, f"reports-{user.user_id}")
+
+
 @user_router.get("/device/{device_id}/reports/stream")
 async def stream_device_reports(
     request: Request,
     device_id: Annotated[UUID, Path],
     user: UserInDB = Depends(get_user_from_token),
+    session: AsyncSession = Depends(get_session),
+    overflow: Annotated[Optional[Overflow], Query()] = None,
 ):
-    # verify that device belongs to user
-    devices = await DeviceRepository.get_users_devices(user.user_id)
-    if device_id not in [device.device_id for device in devices]:
+    await _ensure_user_device(user, device_id, session)
+
+    try:
+        client = connection_manager.connect(device_id, user.user_id, overflow)
+    except TooManyConnections as e:
         raise HTTPException(
-            status_code=404, detail="User does not have a device with that ID"
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail=str(e),
+            headers={"Retry-After": "5"},
         )
 
-    client_queue = asyncio.Queue()
-    await connection_manager.connect(device_id, client_queue)
+    last_event_id = request.headers.get("last-event-id")
+    replay = None
+    if last_event_id:
+        replay = connection_manager.replay(device_id, last_event_id)
 
     async def event_generator():
         try:
-            # Fetch recent reports (e.g., last 10 minutes)
-            start_time = datetime.now() - timedelta(minutes=10)
-            recent_reports = await ReportRepository.get_user_device_reports_after_time(
-                user.user_id, device_id, start_time
-            )
-
-            for report in recent_reports:
-                report_schema = ThermostatReport(
-                    temperature_celcius=report.temperature_celcius,
-                    heater_on=report.heater_on,
-                    timestamp=report.timestamp,
+            if replay is not None:
+                # resumed from the in-memory ring, no history query needed
+                for event_id, message in replay:
+                    yield {"event": "update", "id": event_id, "data": message}
+            else:
+                # Fetch recent reports (e.g., last 10 minutes)
+                start_time = datetime.now() - timedelta(minutes=10)
+                recent_reports = (
+                    await ReportRepository.get_user_device_reports_after_time(
+                        user.user_id, device_id, start_time
+                    )
                 )
-                yield {"event": "historical", "data": report_schema.model_dump_json()}
+
+                for report in recent_reports:
+                    report_schema = ThermostatReport(
+                        temperature_celcius=report.temperature_celcius,
+                        heater_on=report.heater_on,
+                        timestamp=report.timestamp,
+                    )
+                    yield {
+                        "event": "historical",
+                        "data": report_schema.model_dump_json(),
+                    }
 
             while True:
                 if await request.is_disconnected():
                     break
-                message = await client_queue.get()
-                yield {"event": "update", "data": message}
+                # wake up even when the device is silent, to notice a gone
+                # client and to show the sweeper this stream is still alive
+                try:
+                    update = await asyncio.wait_for(
+                        client.get(), connection_manager.heartbeat
+                    )
+                except asyncio.TimeoutError:
+                    yield {"comment": "heartbeat"}
+                    continue
+                if update is None:  # evicted by the sweeper
+                    break
+                event_id, message = update
+                yield {"event": "update", "id": event_id, "data": message}
         finally:
-            connection_manager.disconnect(device_id, client_queue)
+            connection_manager.disconnect(client)
 
     return EventSourceResponse(event_generator())
 
@@ -156,10 +385,11 @@ async def stream_device_reports(
 @user_router.post("/device/{device_id}/schedule")
 async def upload_schedule(
     device_id: Annotated[UUID, Path(title="ID of device to upload schdule")],
+    session: Annotated[AsyncSession, Depends(get_session)],
     schedule: Annotated[Optional[ThermostatSchedule], Body()] = None,
 ):
     try:
-        return await DeviceRepository.update_device_schedule(device_id, schedule)
+        await DeviceRepository.update_device_schedule(device_id, schedule, session)
     except ValueError as e:
         raise HTTPException(status_code=404, detail=str(e))
     except Exception as e:
@@ -170,10 +400,15 @@ async def upload_schedule(
 
 @user_router.get("/device/{device_id}/schedule")
 async def get_schedule(
-    device_id: Annotated[UUID, Path(title="ID of device to get schedule")]
+    device_id: Annotated[UUID, Path(title="ID of device to get schedule")],
+    read_session: Annotated[AsyncSession, Depends(get_read_session)],
+    if_none_match: Annotated[str | None, Header()] = None,
 ):
     try:
-        return await DeviceRepository.get_device_schedule(device_id)
+        schedule_json, version = await DeviceRepository.get_device_schedule_version(
+            device_id, read_session
+        )
+        return schedule_response(schedule_json, version, if_none_match)
     except ValueError as e:
         raise HTTPException(status_code=404, detail=str(e))
     except Exception as e:
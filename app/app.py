@@ -1,9 +1,47 @@
+import contextlib
+import logging
+
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 
 from api.v1 import v1_router
+from repositories import ReportRepository
+from repositories.report_ingest import report_ingest
+from repositories.challenge_store import challenge_store
+from repositories.report_partitions import report_partitions
+from repositories.report_archive import report_archive
+from repositories.retention import retention
+from auth import warm_public_key_cache, crypto_pool
+from realtime import connection_manager, schedule_notifier
+
+logger = logging.getLogger(__name__)
+
+
+@contextlib.asynccontextmanager
+async def lifespan(app: FastAPI):
+    await report_ingest.start(ReportRepository.create_reports)
+    await challenge_store.start()
+    await report_partitions.start()
+    await report_archive.start()
+    await retention.start()
+    await connection_manager.start()
+    await schedule_notifier.start()
+    try:
+        await warm_public_key_cache()
+    except Exception:
+        logger.exception("Failed to pre-warm the public key cache")
+    yield
+    await report_ingest.stop()
+    await challenge_store.stop()
+    await report_partitions.stop()
+    await report_archive.stop()
+    await retention.stop()
+    await connection_manager.stop()
+    await schedule_notifier.stop()
+    crypto_pool.shutdown()
+
 
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
 
 app.include_router(v1_router, prefix="/api/v1")
 
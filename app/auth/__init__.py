@@ -4,6 +4,8 @@ from typing import Annotated
 from dotenv import load_dotenv
 import os
 import base64
+import hashlib
+import logging
 
 import jwt
 from fastapi import Depends, HTTPException, status
@@ -14,14 +16,22 @@ from cryptography.hazmat.primitives import hashes
 from cryptography.hazmat.primitives.asymmetric import padding
 from cryptography.hazmat.primitives import serialization
 from cryptography.exceptions import InvalidSignature
+from sqlalchemy.ext.asyncio import AsyncSession
 
+from database import get_session
 from schemas import UserToken, DeviceToken, AuthRequest
 from models import User, Device, Challenge
-from repositories import UserRepository, DeviceRepository, ChallengeRepository
+from repositories import UserRepository, DeviceRepository
+from repositories.challenge_store import challenge_store
+from repositories.identity_cache import user_cache, device_cache, public_key_cache
+from auth.crypto_pool import crypto_pool, CryptoPoolFull
+
+logger = logging.getLogger(__name__)
 
 load_dotenv()
 JWT_SECRET = str(os.getenv("JWT_SECRET"))
 JWT_ALGORITHM = str(os.getenv("JWT_ALGO"))
+PUBLIC_KEY_WARM_HOURS = int(os.getenv("PUBLIC_KEY_CACHE_WARM_HOURS", "24"))
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 oauth2scheme = OAuth2PasswordBearer(tokenUrl="api/v1/auth/user/login")
 
@@ -34,44 +44,80 @@ def get_password_hash(password):
     return pwd_context.hash(password)
 
 
-async def authenticate_user(email: str, password: str):
-    user: User = await UserRepository.get_user_by_email(email)
+async def authenticate_user(
+    email: str, password: str, session: AsyncSession | None = None
+):
+    user: User = await UserRepository.get_user_by_email(email, session)
     if not user:
         return False
-    if not verify_password(password, user.hashed_password):
+    if not await crypto_pool.run(verify_password, password, user.hashed_password):
         return False
     return user
 
 
-async def authenticate_device(auth_request: AuthRequest):
+def _verify_signature(public_key, signature: bytes, challenge: str):
+    public_key.verify(
+        signature,
+        challenge.encode(),
+        padding.PSS(
+            mgf=padding.MGF1(hashes.SHA256()), salt_length=padding.PSS.MAX_LENGTH
+        ),
+        hashes.SHA256(),
+    )
+
+
+def load_public_key(device: Device):
+    """Parse the device's PEM public key, reusing the cached object if unchanged"""
+    fingerprint = hashlib.sha256(device.public_key.encode()).hexdigest()
+    cached = public_key_cache.get(device.device_id)
+    if cached is not None and cached[0] == fingerprint:
+        return cached[1]
+    public_key = serialization.load_pem_public_key(device.public_key.encode())
+    public_key_cache.put(device.device_id, (fingerprint, public_key))
+    return public_key
+
+
+async def warm_public_key_cache():
+    """Pre-load public keys of devices that reported recently"""
+    since = datetime.now() - timedelta(hours=PUBLIC_KEY_WARM_HOURS)
+    devices = await DeviceRepository.get_recently_active_devices(
+        since, public_key_cache.max_entries
+    )
+    for device in devices:
+        try:
+            load_public_key(device)
+        except ValueError:
+            logger.warning("Device %s has an unparsable public key", device.device_id)
+
+
+async def authenticate_device(
+    auth_request: AuthRequest, session: AsyncSession | None = None
+):
     try:
-        device: Device = await DeviceRepository.get_device_by_id(auth_request.device_id)
+        device: Device = await DeviceRepository.get_device_by_id(
+            auth_request.device_id, session
+        )
     except ValueError as e:
         raise e
 
-    challenge_info: Challenge = await ChallengeRepository.get_challenge(
-        auth_request.device_id
+    challenge_info: Challenge = await challenge_store.get(
+        auth_request.device_id, session, auth_request.challenge
     )
-    if not challenge_info or challenge_info.expires_at < datetime.now():
+    if not challenge_info:
         raise ValueError("Challenge not found or expired")
 
     challenge = challenge_info.challenge
-    public_key = serialization.load_pem_public_key(device.public_key.encode())
+    public_key = load_public_key(device)
     signature = base64.b64decode(auth_request.signature)
 
     try:
-        public_key.verify(
-            signature,
-            challenge.encode(),
-            padding.PSS(
-                mgf=padding.MGF1(hashes.SHA256()), salt_length=padding.PSS.MAX_LENGTH
-            ),
-            hashes.SHA256(),
-        )
+        await crypto_pool.run(_verify_signature, public_key, signature, challenge)
     except InvalidSignature:
         raise ValueError("Invalid signature")
 
-    await ChallengeRepository.delete_challenge(auth_request.device_id)
+    await challenge_store.delete(
+        auth_request.device_id, session, auth_request.challenge
+    )
     return device
 
 
@@ -86,7 +132,10 @@ def create_access_token(data: dict, expires_delta: timedelta | None = None):
     return encoded_jwt
 
 
-async def get_user_from_token(token: Annotated[str, Depends(oauth2scheme)]):
+async def get_user_from_token(
+    token: Annotated[str, Depends(oauth2scheme)],
+    session: Annotated[AsyncSession, Depends(get_session)],
+):
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
@@ -101,34 +150,52 @@ async def get_user_from_token(token: Annotated[str, Depends(oauth2scheme)]):
     except InvalidTokenError:
         raise credentials_exception
 
-    user = await UserRepository.get_user_by_id(token_data.user_id)
-
+    user = user_cache.get(token_data.user_id)
     if user is None:
-        raise credentials_exception
+        user = await UserRepository.get_user_by_id(token_data.user_id, session)
+        if user is None:
+            raise credentials_exception
+        user_cache.put(token_data.user_id, user)
 
     return user
 
 
-async def get_device_from_token(token: Annotated[str, Depends(oauth2scheme)]):
-    credentials_exception = HTTPException(
-        status_code=status.HTTP_401_UNAUTHORIZED,
-        detail="Could not validate credentials",
-        headers={"WWW-Authenticate": "Bearer"},
-    )
+async def load_device_from_token(
+    token: str, session: AsyncSession | None = None
+) -> tuple[Device, datetime]:
+    """Device named by a device access token and when the token expires
+
+    Raises ValueError when the token is invalid or the device is unknown.
+    """
     try:
         payload: dict = jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALGORITHM])
         device_id: UUID | None = payload.get("sub")
         if device_id is None:
-            raise credentials_exception
+            raise ValueError("Token has no subject")
         token_data = DeviceToken(device_id=device_id)
-    except InvalidTokenError:
-        raise credentials_exception
-
-    device = await DeviceRepository.get_device_by_id(token_data.device_id)
+    except InvalidTokenError as e:
+        raise ValueError(str(e))
 
+    device = device_cache.get(token_data.device_id)
     if device is None:
-        raise credentials_exception
+        device = await DeviceRepository.get_device_by_id(token_data.device_id, session)
+        device_cache.put(token_data.device_id, device)
 
+    return device, datetime.fromtimestamp(payload["exp"], timezone.utc)
+
+
+async def get_device_from_token(
+    token: Annotated[str, Depends(oauth2scheme)],
+    session: Annotated[AsyncSession, Depends(get_session)],
+):
+    try:
+        device, _ = await load_device_from_token(token, session)
+    except ValueError:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Could not validate credentials",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
     return device
 
 
@@ -0,0 +1,84 @@
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable
+from dotenv import load_dotenv
+import asyncio
+import os
+import time
+
+
+class CryptoPoolFull(RuntimeError):
+    pass
+
+
+class CryptoPool:
+    """Bounded thread pool for CPU-bound auth work (bcrypt, RSA verification)
+
+    Both bcrypt and cryptography release the GIL while hashing/verifying, so
+    running them here keeps the event loop free. At most `max_pending` calls
+    may be queued or running; further calls fail fast with CryptoPoolFull so
+    an auth storm only slows down logins.
+    """
+
+    def __init__(self, max_workers: int, max_pending: int):
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="crypto"
+        )
+        self._pending = 0
+        self.completed = 0
+        self.rejected = 0
+        self.wait_seconds = 0.0
+        self.run_seconds = 0.0
+
+    async def run(self, fn: Callable[..., Any], *args) -> Any:
+        if self._pending >= self.max_pending:
+            self.rejected += 1
+            raise CryptoPoolFull("Authentication is busy, retry shortly")
+
+        self._pending += 1
+        submitted_at = time.monotonic()
+        try:
+            loop = asyncio.get_running_loop()
+            started_at, finished_at, result, error = await loop.run_in_executor(
+                self._executor, _timed_call, fn, args
+            )
+        finally:
+            self._pending -= 1
+
+        self.completed += 1
+        self.wait_seconds += started_at - submitted_at
+        self.run_seconds += finished_at - started_at
+        if error is not None:
+            raise error
+        return result
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def stats(self) -> dict:
+        return {
+            "max_workers": self.max_workers,
+            "max_pending": self.max_pending,
+            "pending": self._pending,
+            "completed": self.completed,
+            "rejected": self.rejected,
+            "avg_wait_ms": 1000 * self.wait_seconds / max(self.completed, 1),
+            "avg_run_ms": 1000 * self.run_seconds / max(self.completed, 1),
+        }
+
+
+def _timed_call(fn: Callable[..., Any], args: tuple):
+    started_at = time.monotonic()
+    try:
+        result, error = fn(*args), None
+    except Exception as e:
+        result, error = None, e
+    return started_at, time.monotonic(), result, error
+
+
+load_dotenv()
+crypto_pool = CryptoPool(
+    max_workers=int(os.getenv("AUTH_POOL_WORKERS", "2")),
+    max_pending=int(os.getenv("AUTH_POOL_MAX_PENDING", "64")),
+)
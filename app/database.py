@@ -1,36 +1,85 @@
 import threading
 import contextlib
+import logging
 import os
+from datetime import datetime
 from dotenv import load_dotenv
 from uuid import UUID
 
+from fastapi import Depends
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
 from sqlalchemy.orm import sessionmaker
-from sqlalchemy import insert
+from sqlalchemy import insert, text
 
-from models import Base, User
+from models import Base, User, Report
+from partitioning import (
+    REPORT_PARTITIONING,
+    REPORT_PARTITION_MONTHS_AHEAD,
+    report_relkind,
+    create_partitioned_report,
+    ensure_month_partitions,
+    month_start,
+)
+
+logger = logging.getLogger(__name__)
 
 SessionLocal: sessionmaker | None = None
+ReadSessionLocal: sessionmaker | None = None
 _lock = threading.Lock()
 
 
+def _engine_options() -> dict:
+    statement_cache_size = int(os.getenv("POSTGRES_STATEMENT_CACHE_SIZE", "100"))
+    return {
+        "echo": os.getenv("POSTGRES_ECHO", "false").lower() == "true",
+        "pool_size": int(os.getenv("POSTGRES_POOL_SIZE", "5")),
+        "max_overflow": int(os.getenv("POSTGRES_MAX_OVERFLOW", "10")),
+        "pool_pre_ping": os.getenv("POSTGRES_POOL_PRE_PING", "true").lower() == "true",
+        "pool_recycle": int(os.getenv("POSTGRES_POOL_RECYCLE", "-1")),
+        "connect_args": {
+            # sqlalchemy's own cache and asyncpg's, 0 disables both (pgbouncer)
+            "prepared_statement_cache_size": statement_cache_size,
+            "statement_cache_size": statement_cache_size,
+        },
+    }
+
+
 async def init_models():
     load_dotenv()
     POSTGRES_DB = os.getenv("POSTGRES_DB")
     POSTGRES_USER = os.getenv("POSTGRES_USER")
     POSTGRES_PASSWORD = os.getenv("POSTGRES_PASSWORD")
     POSTGRES_HOST = os.getenv("POSTGRES_HOST")
+    POSTGRES_REPLICA_URL = os.getenv("POSTGRES_REPLICA_URL")
 
     engine = create_async_engine(
         f"postgresql+asyncpg://{POSTGRES_USER}:{POSTGRES_PASSWORD}@{POSTGRES_HOST}/{POSTGRES_DB}",
-        echo=True,
+        **_engine_options(),
     )
-    global SessionLocal
+    global SessionLocal, ReadSessionLocal
     SessionLocal = sessionmaker(
         expire_on_commit=False, class_=AsyncSession, bind=engine
     )
+    if POSTGRES_REPLICA_URL:
+        replica_engine = create_async_engine(POSTGRES_REPLICA_URL, **_engine_options())
+        ReadSessionLocal = sessionmaker(
+            expire_on_commit=False, class_=AsyncSession, bind=replica_engine
+        )
+    else:
+        ReadSessionLocal = SessionLocal
     async with engine.begin() as conn:
-        await conn.run_sync(Base.metadata.create_all)
+        if REPORT_PARTITIONING:
+            await _prepare_partitioned_report(conn)
+        else:
+            await conn.run_sync(Base.metadata.create_all)
+        # create_all skips indexes and columns added to existing tables later,
+        # indexes are built by `python -m repositories.report_partitions indexes`
+        await conn.execute(
+            text(
+                "ALTER TABLE device ADD COLUMN IF NOT EXISTS "
+                "schedule_version integer NOT NULL DEFAULT 0"
+            )
+        )
 
         # init admin user
         # try:
@@ -50,8 +99,30 @@ async def init_models():
         #     )
 
 
+async def _prepare_partitioned_report(conn):
+    other_tables = [t for t in Base.metadata.sorted_tables if t is not Report.__table__]
+    await conn.run_sync(Base.metadata.create_all, tables=other_tables)
+
+    relkind = await report_relkind(conn)
+    if relkind is None:
+        await create_partitioned_report(conn)
+        for index in Report.__table__.indexes:
+            await conn.run_sync(index.create)
+    elif relkind != "p":
+        logger.warning(
+            "REPORT_PARTITIONING is set but report is a plain table, run "
+            "`python -m repositories.report_partitions migrate` to convert it"
+        )
+        return
+    now = datetime.now()
+    await ensure_month_partitions(
+        conn, month_start(now), month_start(now, REPORT_PARTITION_MONTHS_AHEAD)
+    )
+
+
 @contextlib.asynccontextmanager
-async def get_db():
+async def get_db(read_only: bool = False):
+    """Open a session on the primary, or on the read replica if `read_only`"""
     global SessionLocal
     if SessionLocal is None:
         with _lock:
@@ -61,8 +132,45 @@ async def get_db():
                 except Exception as e:
                     raise RuntimeError("Failed to initialize database session.") from e
 
-    db: AsyncSession = SessionLocal()
+    db: AsyncSession = ReadSessionLocal() if read_only else SessionLocal()
     try:
         yield db
     finally:
         await db.close()
+
+
+async def get_session():
+    """FastAPI dependency providing one session for the whole request"""
+    async with get_db() as db:
+        yield db
+
+
+async def get_read_session(session: AsyncSession = Depends(get_session)):
+    """FastAPI dependency providing a replica session for the whole request
+
+    Falls back to the request's primary session when no replica is configured.
+    """
+    if ReadSessionLocal is SessionLocal:
+        yield session
+        return
+    async with get_db(read_only=True) as db:
+        yield db
+
+
+# asyncpg caps a statement at 32767 bind parameters
+MAX_BIND_PARAMS = 32767
+
+
+def rows_per_statement(row_params: int, fixed_params: int = 0) -> int:
+    """How many rows of `row_params` bind parameters fit in one statement"""
+    return (MAX_BIND_PARAMS - fixed_params) // row_params
+
+
+@contextlib.asynccontextmanager
+async def use_session(session: AsyncSession | None, read_only: bool = False):
+    """Reuse the caller's session, or open a short-lived one if there is none"""
+    if session is not None:
+        yield session
+        return
+    async with get_db(read_only) as db:
+        yield db
@@ -1,7 +1,17 @@
 from datetime import datetime
 import uuid
 
-from sqlalchemy import ForeignKey, DateTime, UUID, Boolean, JSON, Float, Text
+from sqlalchemy import (
+    ForeignKey,
+    DateTime,
+    UUID,
+    Boolean,
+    JSON,
+    Float,
+    Text,
+    Index,
+    Integer,
+)
 from sqlalchemy.orm import DeclarativeBase, mapped_column, Mapped, relationship
 
 
@@ -35,6 +45,10 @@ class Device(Base):
         UUID, ForeignKey("user.user_id"), nullable=True
     )  # if device is not registered, user_id is None
     schedule: Mapped[dict] = mapped_column(JSON, nullable=True)
+    # bumped on every schedule write, lets devices wait for a newer one
+    schedule_version: Mapped[int] = mapped_column(
+        Integer, nullable=False, default=0, server_default="0"
+    )
     register_timestamp: Mapped[datetime] = mapped_column(DateTime, nullable=True)
     creation_timestamp: Mapped[datetime] = mapped_column(
         DateTime, nullable=False, default=datetime.now
@@ -44,6 +58,10 @@ class Device(Base):
 
 class Report(Base):
     __tablename__ = "report"
+    __table_args__ = (
+        Index("ix_report_device_timestamp", "device_id", "timestamp"),
+        Index("ix_report_user_device_timestamp", "user_id", "device_id", "timestamp"),
+    )
 
     report_id: Mapped[uuid.UUID] = mapped_column(
         UUID, primary_key=True, default=uuid.uuid4
@@ -55,6 +73,28 @@ class Report(Base):
     timestamp: Mapped[datetime] = mapped_column(DateTime, nullable=False)
 
 
+class ReportRollupMixin:
+    """Per device aggregate of the reports whose timestamp falls in a bucket"""
+
+    device_id: Mapped[uuid.UUID] = mapped_column(
+        UUID, ForeignKey("device.device_id"), primary_key=True
+    )
+    bucket_start: Mapped[datetime] = mapped_column(DateTime, primary_key=True)
+    count: Mapped[int] = mapped_column(Integer, nullable=False)
+    temperature_sum: Mapped[float] = mapped_column(Float, nullable=False)
+    temperature_min: Mapped[float] = mapped_column(Float, nullable=False)
+    temperature_max: Mapped[float] = mapped_column(Float, nullable=False)
+    heater_on_count: Mapped[int] = mapped_column(Integer, nullable=False)
+
+
+class ReportRollupHour(ReportRollupMixin, Base):
+    __tablename__ = "report_rollup_hour"
+
+
+class ReportRollupDay(ReportRollupMixin, Base):
+    __tablename__ = "report_rollup_day"
+
+
 class Challenge(Base):
     __tablename__ = "challenge"
 
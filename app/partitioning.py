@@ -0,0 +1,102 @@
+from datetime import datetime
+from dotenv import load_dotenv
+import os
+
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncConnection, AsyncSession
+
+load_dotenv()
+REPORT_PARTITIONING = os.getenv("REPORT_PARTITIONING", "false").lower() == "true"
+REPORT_PARTITION_MONTHS_AHEAD = int(os.getenv("REPORT_PARTITION_MONTHS_AHEAD", "2"))
+
+# Same columns as models.Report, but the primary key has to include the
+# partition key. report_id stays unique in practice, it is a uuid4.
+_PARTITIONED_REPORT_DDL = """
+CREATE TABLE {name} (
+    report_id UUID NOT NULL,
+    user_id UUID REFERENCES "user" (user_id),
+    device_id UUID REFERENCES device (device_id),
+    temperature_celcius FLOAT NOT NULL,
+    heater_on BOOLEAN NOT NULL,
+    timestamp TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+    PRIMARY KEY (report_id, timestamp)
+) PARTITION BY RANGE (timestamp)
+"""
+
+
+def month_start(moment: datetime, offset: int = 0) -> datetime:
+    """First instant of the month `offset` months after `moment`'s month"""
+    month = moment.year * 12 + moment.month - 1 + offset
+    return datetime(month // 12, month % 12 + 1, 1)
+
+
+def partition_name(month: datetime) -> str:
+    return f"report_y{month.year}m{month.month:02d}"
+
+
+async def report_relkind(conn: AsyncConnection | AsyncSession) -> str | None:
+    """'p' if report is partitioned, 'r' if it is a plain table, None if missing"""
+    result = await conn.execute(
+        text(
+            "SELECT relkind FROM pg_class "
+            "WHERE relname = 'report' AND relnamespace = current_schema()::regnamespace"
+        )
+    )
+    return result.scalar()
+
+
+async def create_partitioned_report(
+    conn: AsyncConnection | AsyncSession, name: str = "report"
+):
+    await conn.execute(text(_PARTITIONED_REPORT_DDL.format(name=name)))
+    # catches rows outside every monthly partition instead of failing inserts
+    await conn.execute(
+        text(f"CREATE TABLE IF NOT EXISTS {name}_default PARTITION OF {name} DEFAULT")
+    )
+
+
+async def ensure_month_partitions(
+    conn: AsyncConnection | AsyncSession, first: datetime, last: datetime
+):
+    """Create monthly partitions covering every month from `first` to `last`"""
+    month = month_start(first)
+    while month <= last:
+        await ensure_month_partition(conn, month)
+        month = month_start(month, 1)
+
+
+async def ensure_month_partition(conn: AsyncConnection | AsyncSession, month: datetime):
+    """Create the partition of `month` unless it exists
+
+    Device clocks can stamp reports months ahead, such rows wait in the
+    default partition and Postgres refuses to add a partition overlapping
+    them, so they are moved into the new partition.
+    """
+    name = partition_name(month)
+    result = await conn.execute(text("SELECT to_regclass(:name)"), {"name": name})
+    if result.scalar() is not None:
+        return
+    next_month = month_start(month, 1)
+    create = text(
+        f"CREATE TABLE IF NOT EXISTS {name} PARTITION OF report FOR VALUES "
+        f"FROM ('{month.isoformat()}') TO ('{next_month.isoformat()}')"
+    )
+    in_month = (
+        f"timestamp >= '{month.isoformat()}' AND timestamp < '{next_month.isoformat()}'"
+    )
+    result = await conn.execute(
+        text(f"SELECT EXISTS (SELECT 1 FROM report_default WHERE {in_month})")
+    )
+    if not result.scalar():
+        await conn.execute(create)
+        return
+
+    await conn.execute(text("ALTER TABLE report DETACH PARTITION report_default"))
+    await conn.execute(create)
+    await conn.execute(
+        text(f"INSERT INTO {name} SELECT * FROM report_default WHERE {in_month}")
+    )
+    await conn.execute(text(f"DELETE FROM report_default WHERE {in_month}"))
+    await conn.execute(
+        text("ALTER TABLE report ATTACH PARTITION report_default DEFAULT")
+    )
@@ -0,0 +1,9 @@
+from realtime.connections import (
+    ConnectionManager,
+    Subscriber,
+    Overflow,
+    TooManyConnections,
+    connection_manager,
+)
+from realtime.broker import Broker, LocalBroker, PostgresBroker
+from realtime.schedules import ScheduleNotifier, schedule_notifier
@@ -0,0 +1,127 @@
+from abc import ABC, abstractmethod
+from typing import Callable
+import asyncio
+import json
+import logging
+import os
+
+import asyncpg
+
+logger = logging.getLogger(__name__)
+
+Deliver = Callable[[str, str], None]
+
+
+class Broker(ABC):
+    """Carries (device_id, message) pairs to the listeners on every worker
+
+    `start` registers the local delivery callback; `publish` hands a message
+    to the broker, which calls that callback on each subscribed worker,
+    including the publishing one.
+    """
+
+    async def start(self, deliver: Deliver):
+        self._deliver = deliver
+
+    async def stop(self):
+        pass
+
+    @abstractmethod
+    async def publish(self, device_id: str, message: str): ...
+
+
+class LocalBroker(Broker):
+    """In-process only, updates reach the SSE clients of this worker"""
+
+    async def publish(self, device_id, message):
+        self._deliver(device_id, message)
+
+
+class PostgresBroker(Broker):
+    """LISTEN/NOTIFY over one dedicated asyncpg connection per worker
+
+    The connection stays outside the SQLAlchemy pool (and must bypass a
+    transaction-mode pgbouncer) because LISTEN is bound to the session.
+    A dropped connection is re-established every `reconnect_s` seconds;
+    updates sent while it is down are lost, which SSE clients tolerate.
+    """
+
+    def __init__(self, dsn: str, channel: str, reconnect_s: float):
+        self.dsn = dsn
+        self.channel = channel
+        self.reconnect = reconnect_s
+        self._connection: asyncpg.Connection | None = None
+        # asyncpg runs one operation at a time per connection
+        self._publish_lock = asyncio.Lock()
+        self._task: asyncio.Task | None = None
+
+    async def start(self, deliver):
+        await super().start(deliver)
+        try:
+            await self._connect()
+        except Exception:
+            logger.exception("Failed to LISTEN on %s, retrying", self.channel)
+        self._task = asyncio.create_task(self._watch())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._connection is not None:
+            await self._connection.close()
+            self._connection = None
+
+    async def publish(self, device_id, message):
+        if self._connection is None or self._connection.is_closed():
+            raise ConnectionError("Report broker connection is down")
+        payload = json.dumps({"device_id": device_id, "message": message})
+        async with self._publish_lock:
+            await self._connection.execute(
+                "SELECT pg_notify($1, $2)", self.channel, payload
+            )
+
+    async def _connect(self):
+        connection = await asyncpg.connect(self.dsn)
+        await connection.add_listener(self.channel, self._on_notify)
+        self._connection = connection
+
+    async def _watch(self):
+        while True:
+            await asyncio.sleep(self.reconnect)
+            if self._connection is not None and not self._connection.is_closed():
+                continue
+            try:
+                await self._connect()
+                logger.info("Re-established LISTEN on %s", self.channel)
+            except Exception:
+                logger.warning("Report broker still disconnected, retrying")
+
+    def _on_notify(self, connection, pid, channel, payload):
+        try:
+            notification = json.loads(payload)
+            self._deliver(notification["device_id"], notification["message"])
+        except (ValueError, KeyError):
+            logger.warning("Ignoring malformed notification on %s", channel)
+
+
+def make_broker(channel: str) -> Broker:
+    backend = os.getenv("SSE_BROKER", "local")
+    if backend == "local":
+        return LocalBroker()
+    if backend == "postgres":
+        dsn = "postgresql://{}:{}@{}/{}".format(
+            os.getenv("POSTGRES_USER"),
+            os.getenv("POSTGRES_PASSWORD"),
+            os.getenv("POSTGRES_HOST"),
+            os.getenv("POSTGRES_DB"),
+        )
+        return PostgresBroker(
+            dsn,
+            channel,
+            float(os.getenv("SSE_BROKER_RECONNECT_S", "5")),
+        )
+    raise ValueError(f"Unknown SSE_BROKER backend {backend!r}")
@@ -0,0 +1,319 @@
+from collections import OrderedDict, deque
+from enum import Enum
+from typing import Callable
+from dotenv import load_dotenv
+import asyncio
+import logging
+import itertools
+import os
+import secrets
+import time
+
+from realtime.broker import Broker, make_broker
+
+logger = logging.getLogger(__name__)
+
+
+class Overflow(str, Enum):
+    DROP_OLDEST = "drop_oldest"  # keep the newest `max_queue` messages
+    LATEST = "latest"  # only the most recent reading is kept
+
+
+class TooManyConnections(RuntimeError):
+    pass
+
+
+class Subscriber:
+    """Bounded mailbox of one SSE client, `offer` never blocks the publisher"""
+
+    def __init__(
+        self, device_id: str, user_id: str, max_queue: int, overflow: Overflow
+    ):
+        self.device_id = device_id
+        self.user_id = user_id
+        self.max_queue = 1 if overflow == Overflow.LATEST else max_queue
+        self.overflow = overflow
+        self._pending: deque[tuple[float, str, str]] = deque()
+        self._ready = asyncio.Event()
+        self.closed = False
+        self.last_poll = time.monotonic()
+        self.delivered = 0
+        self.dropped = 0
+
+    def offer(self, event_id: str, message: str):
+        if self.closed:
+            return
+        if len(self._pending) >= self.max_queue:
+            self._pending.popleft()
+            self.dropped += 1
+        self._pending.append((time.monotonic(), event_id, message))
+        self._ready.set()
+
+    async def get(self) -> tuple[str, str] | None:
+        self.last_poll = time.monotonic()
+        while not self._pending and not self.closed:
+            self._ready.clear()
+            await self._ready.wait()
+        if self.closed:
+            return None
+        _, event_id, message = self._pending.popleft()
+        self.delivered += 1
+        return event_id, message
+
+    def close(self):
+        self.closed = True
+        self._pending.clear()
+        self._ready.set()
+
+    @property
+    def lag(self) -> float:
+        """Seconds the oldest undelivered message has been waiting"""
+        if not self._pending:
+            return 0.0
+        return time.monotonic() - self._pending[0][0]
+
+    def stats(self) -> dict:
+        return {
+            "user_id": self.user_id,
+            "overflow": self.overflow.value,
+            "pending": len(self._pending),
+            "delivered": self.delivered,
+            "dropped": self.dropped,
+            "lag_s": self.lag,
+            "idle_s": time.monotonic() - self.last_poll,
+        }
+
+
+class _ReplayRing:
+    """Last messages of one device as (seq, message), oldest first"""
+
+    __slots__ = ("entries", "evicted_through")
+
+    def __init__(self, size: int):
+        self.entries: deque[tuple[int, str]] = deque(maxlen=size)
+        self.evicted_through = 0
+
+    @property
+    def last_seq(self) -> int:
+        return self.entries[-1][0] if self.entries else self.evicted_through
+
+    def append(self, seq: int, message: str):
+        if len(self.entries) == self.entries.maxlen:
+            self.evicted_through = self.entries[0][0] if self.entries else seq
+        self.entries.append((seq, message))
+
+
+class ConnectionManager:
+    """Fans device reports out to the SSE clients watching them, via the broker"""
+
+    def __init__(
+        self,
+        broker: Broker,
+        max_queue: int,
+        overflow: Overflow,
+        max_dispatch: int,
+        max_connections: int,
+        max_connections_per_user: int,
+        heartbeat_s: float,
+        idle_timeout_s: float,
+        replay_size: int,
+        replay_devices: int,
+    ):
+        self.broker = broker
+        self.max_queue = max_queue
+        self.overflow = overflow
+        self.max_connections = max_connections
+        self.max_connections_per_user = max_connections_per_user
+        self.heartbeat = heartbeat_s
+        self.idle_timeout = idle_timeout_s
+        self.replay_size = replay_size
+        self.replay_devices = replay_devices
+        self._replay: OrderedDict[str, _ReplayRing] = OrderedDict()
+        self._replay_floor = 0
+        self._epoch = secrets.token_hex(4)
+        self._sequence = itertools.count(1)
+        self.active_connections: dict[str, set[Subscriber]] = {}
+        self._user_connections: dict[str, int] = {}
+        self._connection_count = 0
+        self._dispatch: asyncio.Queue[tuple[str, str]] = asyncio.Queue(
+            maxsize=max_dispatch
+        )
+        self._tasks: list[asyncio.Task] = []
+        self.dispatch_dropped = 0
+        self.rejected = 0
+        self.evicted = 0
+        self._listeners: list[Callable[[str, str], None]] = []
+
+    async def start(self):
+        await self.broker.start(self._fan_out)
+        self._tasks = [
+            asyncio.create_task(self._run()),
+            asyncio.create_task(self._sweep()),
+        ]
+
+    async def stop(self):
+        if not self._tasks:
+            return
+        for task in self._tasks:
+            task.cancel()
+        for task in self._tasks:
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        self._tasks = []
+        await self.broker.stop()
+
+    def connect(
+        self, device_id, user_id, overflow: Overflow | None = None
+    ) -> Subscriber:
+        # ids are keyed as strings, the broker carries them as text
+        device_id, user_id = str(device_id), str(user_id)
+        if self._connection_count >= self.max_connections:
+            self.rejected += 1
+            raise TooManyConnections("Too many open report streams, retry later")
+        if self._user_connections.get(user_id, 0) >= self.max_connections_per_user:
+            self.rejected += 1
+            raise TooManyConnections("Too many open report streams for this user")
+
+        client = Subscriber(
+            device_id, user_id, self.max_queue, overflow or self.overflow
+        )
+        self.active_connections.setdefault(device_id, set()).add(client)
+        self._user_connections[user_id] = self._user_connections.get(user_id, 0) + 1
+        self._connection_count += 1
+        return client
+
+    def disconnect(self, client: Subscriber):
+        client.close()
+        clients = self.active_connections.get(client.device_id)
+        if clients is None or client not in clients:
+            return
+        clients.remove(client)
+        if not clients:
+            del self.active_connections[client.device_id]
+        remaining = self._user_connections[client.user_id] - 1
+        if remaining:
+            self._user_connections[client.user_id] = remaining
+        else:
+            del self._user_connections[client.user_id]
+        self._connection_count -= 1
+
+    def publish(self, device_id, message: str):
+        device_id = str(device_id)
+        if not self._tasks:
+            self._fan_out(device_id, message)
+            return
+        try:
+            self._dispatch.put_nowait((device_id, message))
+        except asyncio.QueueFull:
+            self.dispatch_dropped += 1
+            logger.warning("SSE dispatch queue full, dropped a report update")
+
+    async def _run(self):
+        while True:
+            device_id, message = await self._dispatch.get()
+            try:
+                await self.broker.publish(device_id, message)
+            except Exception:
+                logger.exception("Failed to publish a report update")
+
+    async def _sweep(self):
+        while True:
+            await asyncio.sleep(self.heartbeat)
+            cutoff = time.monotonic() - self.idle_timeout
+            stale = [
+                client
+                for clients in self.active_connections.values()
+                for client in clients
+                if client.last_poll < cutoff
+            ]
+            for client in stale:
+                self.disconnect(client)
+            if stale:
+                self.evicted += len(stale)
+                logger.info("Evicted %d idle SSE clients", len(stale))
+
+    def add_listener(self, listener: Callable[[str, str], None]):
+        """Call `listener(device_id, message)` for every report this worker sees"""
+        self._listeners.append(listener)
+
+    def _fan_out(self, device_id: str, message: str):
+        for listener in self._listeners:
+            try:
+                listener(device_id, message)
+            except Exception:
+                logger.exception("Report listener failed")
+
+        seq = next(self._sequence)
+        ring = self._replay.get(device_id)
+        if ring is None:
+            ring = self._replay[device_id] = _ReplayRing(self.replay_size)
+            if len(self._replay) > self.replay_devices:
+                _, dropped = self._replay.popitem(last=False)
+                self._replay_floor = max(self._replay_floor, dropped.last_seq)
+        else:
+            self._replay.move_to_end(device_id)
+        ring.append(seq, message)
+
+        event_id = f"{self._epoch}-{seq}"
+        for client in self.active_connections.get(device_id, ()):
+            client.offer(event_id, message)
+
+    def replay(self, device_id, last_event_id: str) -> list[tuple[str, str]] | None:
+        """Messages after `last_event_id`, None if the ring no longer covers it
+
+        Call right after `connect` so nothing falls between the two.
+        """
+        epoch, _, seq = last_event_id.partition("-")
+        if epoch != self._epoch or not seq.isdigit():
+            return None
+        seq = int(seq)
+        ring = self._replay.get(str(device_id))
+        if ring is None:
+            # never published since, unless its ring was dropped for space
+            return None if seq < self._replay_floor else []
+        if seq < ring.evicted_through:
+            return None
+        return [
+            (f"{self._epoch}-{ring_seq}", message)
+            for ring_seq, message in ring.entries
+            if ring_seq > seq
+        ]
+
+    def counts(self) -> dict:
+        return {
+            "connections": self._connection_count,
+            "devices": len(self.active_connections),
+            "users": len(self._user_connections),
+            "rejected": self.rejected,
+            "evicted": self.evicted,
+        }
+
+    def stats(self) -> dict:
+        return {
+            "broker": type(self.broker).__name__,
+            **self.counts(),
+            "replay_devices": len(self._replay),
+            "dispatch_pending": self._dispatch.qsize(),
+            "dispatch_dropped": self.dispatch_dropped,
+            "subscribers": {
+                device_id: [client.stats() for client in clients]
+                for device_id, clients in self.active_connections.items()
+            },
+        }
+
+
+load_dotenv()
+connection_manager = ConnectionManager(
+    broker=make_broker(os.getenv("SSE_BROKER_CHANNEL", "report_updates")),
+    max_queue=int(os.getenv("SSE_QUEUE_SIZE", "100")),
+    overflow=Overflow(os.getenv("SSE_OVERFLOW", "drop_oldest")),
+    max_dispatch=int(os.getenv("SSE_DISPATCH_MAX_PENDING", "10000")),
+    max_connections=int(os.getenv("SSE_MAX_CONNECTIONS", "1000")),
+    max_connections_per_user=int(os.getenv("SSE_MAX_CONNECTIONS_PER_USER", "10")),
+    heartbeat_s=float(os.getenv("SSE_HEARTBEAT_S", "15")),
+    idle_timeout_s=float(os.getenv("SSE_IDLE_TIMEOUT_S", "60")),
+    replay_size=int(os.getenv("SSE_REPLAY_SIZE", "256")),
+    replay_devices=int(os.getenv("SSE_REPLAY_DEVICES", "10000")),
+)
@@ -0,0 +1,75 @@
+from dotenv import load_dotenv
+import asyncio
+import logging
+import os
+
+from realtime.broker import Broker, make_broker
+
+logger = logging.getLogger(__name__)
+
+
+class ScheduleNotifier:
+    """Tells the devices connected to any worker that their schedule changed
+
+    Listeners get a one-slot mailbox holding the newest notification,
+    `{"version": <int>, "schedule": <schedule or null>}` as JSON; a schedule
+    is a full replacement, so older undelivered ones are simply overwritten.
+    """
+
+    def __init__(self, broker: Broker):
+        self.broker = broker
+        self._listeners: dict[str, set[asyncio.Queue[str]]] = {}
+        self._started = False
+
+    async def start(self):
+        await self.broker.start(self._deliver)
+        self._started = True
+
+    async def stop(self):
+        if not self._started:
+            return
+        self._started = False
+        await self.broker.stop()
+
+    def subscribe(self, device_id) -> asyncio.Queue[str]:
+        mailbox: asyncio.Queue[str] = asyncio.Queue(maxsize=1)
+        self._listeners.setdefault(str(device_id), set()).add(mailbox)
+        return mailbox
+
+    def unsubscribe(self, device_id, mailbox: asyncio.Queue[str]):
+        listeners = self._listeners.get(str(device_id))
+        if listeners is None:
+            return
+        listeners.discard(mailbox)
+        if not listeners:
+            del self._listeners[str(device_id)]
+
+    async def notify(self, device_id, version: int, schedule_json: str | None):
+        # schedule_json is already valid JSON, no need to parse it again
+        message = f'{{"version": {version}, "schedule": {schedule_json or "null"}}}'
+        if not self._started:
+            self._deliver(str(device_id), message)
+            return
+        try:
+            await self.broker.publish(str(device_id), message)
+        except Exception:
+            # devices still get the schedule when they reconnect or poll
+            logger.exception("Failed to push a schedule update")
+
+    def _deliver(self, device_id: str, message: str):
+        for mailbox in self._listeners.get(device_id, ()):
+            if mailbox.full():
+                mailbox.get_nowait()
+            mailbox.put_nowait(message)
+
+    def stats(self) -> dict:
+        return {
+            "devices": len(self._listeners),
+            "listeners": sum(len(listeners) for listeners in self._listeners.values()),
+        }
+
+
+load_dotenv()
+schedule_notifier = ScheduleNotifier(
+    broker=make_broker(os.getenv("SCHEDULE_BROKER_CHANNEL", "schedule_updates")),
+)
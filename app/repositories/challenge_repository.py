@@ -2,18 +2,25 @@ from datetime import datetime
 from uuid import UUID
 
 from sqlalchemy.exc import SQLAlchemyError
-from sqlalchemy import select, delete
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import select, delete, case, literal
+from sqlalchemy.dialects.postgresql import insert
 
-from models import Challenge
-from database import get_db
+from models import Challenge, Device
+from database import use_session
 
 
 class ChallengeRepository:
     """Stateless collection of DB access functions for Challenge model"""
 
     @staticmethod
-    async def create_challenge(device_id: UUID, challenge: str, expires_at: datetime):
-        async with get_db() as session:
+    async def create_challenge(
+        device_id: UUID,
+        challenge: str,
+        expires_at: datetime,
+        session: AsyncSession | None = None,
+    ):
+        async with use_session(session) as session:
             try:
                 new_challenge = Challenge(
                     device_id=device_id, challenge=challenge, expires_at=expires_at
@@ -25,8 +32,61 @@ class ChallengeRepository:
                 raise e
 
     @staticmethod
-    async def get_challenge(device_id: UUID) -> Challenge:
-        async with get_db() as session:
+    async def issue_challenge(
+        device_id: UUID,
+        challenge: str,
+        expires_at: datetime,
+        session: AsyncSession | None = None,
+    ) -> Challenge | None:
+        """Return the device's live challenge, or store the given one
+
+        One INSERT ... SELECT ... ON CONFLICT: the SELECT makes it a no-op
+        for unknown devices (returns None), the conflict clause keeps an
+        unexpired nonce and replaces an expired one, atomically per device.
+        """
+        async with use_session(session) as session:
+            try:
+                stmt = insert(Challenge).from_select(
+                    ["device_id", "challenge", "expires_at"],
+                    select(
+                        Device.device_id,
+                        literal(challenge),
+                        literal(expires_at),
+                    ).where(Device.device_id == device_id),
+                )
+                expired = Challenge.expires_at < datetime.now()
+                stmt = stmt.on_conflict_do_update(
+                    index_elements=[Challenge.device_id],
+                    set_={
+                        "challenge": case(
+                            (expired, stmt.excluded.challenge),
+                            else_=Challenge.challenge,
+                        ),
+                        "expires_at": case(
+                            (expired, stmt.excluded.expires_at),
+                            else_=Challenge.expires_at,
+                        ),
+                    },
+                ).returning(Challenge.challenge, Challenge.expires_at)
+                result = await session.execute(stmt)
+                row = result.first()
+                await session.commit()
+                if row is None:
+                    return None
+                return Challenge(
+                    device_id=device_id,
+                    challenge=row.challenge,
+                    expires_at=row.expires_at,
+                )
+            except SQLAlchemyError as e:
+                await session.rollback()
+                raise e
+
+    @staticmethod
+    async def get_challenge(
+        device_id: UUID, session: AsyncSession | None = None
+    ) -> Challenge:
+        async with use_session(session) as session:
             try:
                 stmt = select(Challenge).filter(Challenge.device_id == device_id)
                 result = await session.execute(stmt)
@@ -35,8 +95,8 @@ class ChallengeRepository:
                 raise e
 
     @staticmethod
-    async def delete_challenge(device_id: UUID):
-        async with get_db() as session:
+    async def delete_challenge(device_id: UUID, session: AsyncSession | None = None):
+        async with use_session(session) as session:
             try:
                 stmt = delete(Challenge).where(Challenge.device_id == device_id)
                 await session.execute(stmt)
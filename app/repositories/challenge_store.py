@@ -0,0 +1,322 @@
+from abc import ABC, abstractmethod
+from datetime import datetime, timedelta
+from uuid import UUID, uuid4
+from dotenv import load_dotenv
+import asyncio
+import hashlib
+import hmac
+import os
+import secrets
+
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from models import Challenge
+from repositories.challenge_repository import ChallengeRepository
+from repositories.device_repository import DeviceRepository
+from repositories.identity_cache import device_cache
+
+
+class ChallengeStore(ABC):
+    """Where pending device login nonces live until they are used or expire
+
+    `session` is only used by the table backend, the others ignore it.
+    """
+
+    def __init__(self, ttl_s: int):
+        self.ttl = timedelta(seconds=ttl_s)
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+    @abstractmethod
+    async def get(
+        self,
+        device_id: UUID,
+        session: AsyncSession | None = None,
+        presented: str | None = None,
+    ) -> Challenge | None:
+        """Live challenge for the device, None if there is none or it expired
+
+        `presented` is the challenge string the device sent back, only the
+        signed backend needs it.
+        """
+
+    @abstractmethod
+    async def issue(
+        self, device_id: UUID, session: AsyncSession | None = None
+    ) -> Challenge | None:
+        """Return the device's live challenge, creating a new one if needed
+
+        Returns None if the device does not exist.
+        """
+
+    @abstractmethod
+    async def delete(
+        self,
+        device_id: UUID,
+        session: AsyncSession | None = None,
+        presented: str | None = None,
+    ):
+        """Consume the challenge once the device's signature checked out
+
+        The signed backend raises ValueError if `presented` was already used.
+        """
+
+    @staticmethod
+    async def _device_exists(device_id: UUID, session: AsyncSession | None) -> bool:
+        if device_cache.get(device_id) is not None:
+            return True
+        try:
+            await DeviceRepository.get_device_by_id(device_id, session)
+        except ValueError:
+            return False
+        return True
+
+    def _new_challenge(self, device_id: UUID) -> Challenge:
+        return Challenge(
+            device_id=device_id,
+            challenge=uuid4().hex,
+            expires_at=datetime.now() + self.ttl,
+        )
+
+
+class TableChallengeStore(ChallengeStore):
+    """Challenges in the Postgres `challenge` table"""
+
+    async def get(self, device_id, session=None, presented=None):
+        challenge = await ChallengeRepository.get_challenge(device_id, session)
+        if challenge is None or challenge.expires_at < datetime.now():
+            return None
+        return challenge
+
+    async def issue(self, device_id, session=None):
+        new_challenge = self._new_challenge(device_id)
+        return await ChallengeRepository.issue_challenge(
+            device_id, new_challenge.challenge, new_challenge.expires_at, session
+        )
+
+    async def delete(self, device_id, session=None, presented=None):
+        await ChallengeRepository.delete_challenge(device_id, session)
+
+
+class MemoryChallengeStore(ChallengeStore):
+    """Challenges in a per-process dict, swept periodically for expired entries
+
+    Only correct with a single worker, a device must log in against the same
+    process that issued its challenge.
+    """
+
+    def __init__(self, ttl_s: int, sweep_interval_s: float):
+        super().__init__(ttl_s)
+        self.sweep_interval = sweep_interval_s
+        self._challenges: dict[UUID, Challenge] = {}
+        self._task: asyncio.Task | None = None
+
+    async def start(self):
+        self._task = asyncio.create_task(self._sweep())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    async def get(self, device_id, session=None, presented=None):
+        challenge = self._challenges.get(device_id)
+        if challenge is None or challenge.expires_at < datetime.now():
+            return None
+        return challenge
+
+    async def issue(self, device_id, session=None):
+        challenge = await self.get(device_id)
+        if challenge is None:
+            if not await self._device_exists(device_id, session):
+                return None
+            challenge = self._new_challenge(device_id)
+            self._challenges[device_id] = challenge
+        return challenge
+
+    async def delete(self, device_id, session=None, presented=None):
+        self._challenges.pop(device_id, None)
+
+    async def _sweep(self):
+        while True:
+            await asyncio.sleep(self.sweep_interval)
+            now = datetime.now()
+            expired = [
+                device_id
+                for device_id, challenge in self._challenges.items()
+                if challenge.expires_at < now
+            ]
+            for device_id in expired:
+                del self._challenges[device_id]
+
+
+class RedisChallengeStore(ChallengeStore):
+    """Challenges in Redis, shared by every worker and expired by Redis itself
+
+    Any Redis-protocol server works, e.g. a local `redis-server`; the tests
+    pass a `fakeredis` client.
+    """
+
+    def __init__(self, ttl_s: int, url: str, client=None):
+        super().__init__(ttl_s)
+        if client is None:
+            try:
+                import redis.asyncio as redis
+            except ImportError as e:
+                raise RuntimeError(
+                    "CHALLENGE_STORE=redis requires the redis package"
+                ) from e
+            client = redis.from_url(url)
+        self._redis = client
+
+    async def stop(self):
+        await self._redis.aclose()
+
+    @staticmethod
+    def _key(device_id: UUID) -> str:
+        return f"challenge:{device_id}"
+
+    async def get(self, device_id, session=None, presented=None):
+        value = await self._redis.get(self._key(device_id))
+        if value is None:
+            return None
+        challenge, expires_at = value.decode().split("|")
+        return Challenge(
+            device_id=device_id,
+            challenge=challenge,
+            expires_at=datetime.fromisoformat(expires_at),
+        )
+
+    async def issue(self, device_id, session=None):
+        challenge = await self.get(device_id)
+        if challenge is not None:
+            return challenge
+        if not await self._device_exists(device_id, session):
+            return None
+
+        new_challenge = self._new_challenge(device_id)
+        value = f"{new_challenge.challenge}|{new_challenge.expires_at.isoformat()}"
+        # only one concurrent request can create the key, the others read it
+        created = await self._redis.set(
+            self._key(device_id),
+            value,
+            nx=True,
+            px=int(self.ttl / timedelta(milliseconds=1)),
+        )
+        if created:
+            return new_challenge
+        challenge = await self.get(device_id)
+        return (
+            challenge if challenge is not None else await self.issue(device_id, session)
+        )
+
+    async def delete(self, device_id, session=None, presented=None):
+        await self._redis.delete(self._key(device_id))
+
+
+class SignedChallengeStore(ChallengeStore):
+    """Self-authenticating challenges that are never stored
+
+    A challenge is `<device_id>.<nonce>.<expiry>.<hmac>`; the device echoes it
+    back on login and the HMAC proves this server issued it. Replays are
+    refused by remembering nonces redeemed with a valid signature until they
+    expire. That set is
+    per process, so with several workers a nonce can be redeemed once per
+    worker, each redemption still needing the device's signature.
+    """
+
+    def __init__(self, ttl_s: int, secret: str):
+        super().__init__(ttl_s)
+        self._secret = secret.encode()
+        self._seen: dict[str, float] = {}
+        self._next_prune = 0.0
+
+    def _mac(self, payload: str) -> str:
+        return hmac.new(self._secret, payload.encode(), hashlib.sha256).hexdigest()
+
+    async def get(self, device_id, session=None, presented=None):
+        if presented is None:
+            return None
+        try:
+            claimed_id, nonce, expiry, mac = presented.split(".")
+            expires_at = float(expiry)
+        except ValueError:
+            return None
+        payload = f"{claimed_id}.{nonce}.{expiry}"
+        if not hmac.compare_digest(mac, self._mac(payload)):
+            return None
+        now = datetime.now().timestamp()
+        if claimed_id != str(device_id) or expires_at < now:
+            return None
+
+        self._prune_seen(now)
+        if nonce in self._seen:
+            return None
+        return Challenge(
+            device_id=device_id,
+            challenge=presented,
+            expires_at=datetime.fromtimestamp(expires_at),
+        )
+
+    async def issue(self, device_id, session=None):
+        if not await self._device_exists(device_id, session):
+            return None
+        expires_at = datetime.now() + self.ttl
+        payload = f"{device_id}.{secrets.token_hex(16)}.{int(expires_at.timestamp())}"
+        return Challenge(
+            device_id=device_id,
+            challenge=f"{payload}.{self._mac(payload)}",
+            expires_at=expires_at,
+        )
+
+    async def delete(self, device_id, session=None, presented=None):
+        # only called after get accepted `presented`, so it parses
+        _, nonce, expiry, _ = presented.split(".")
+        # checked and marked without awaiting in between, so concurrent logins
+        # with the same challenge cannot both get past this point
+        if nonce in self._seen:
+            raise ValueError("Challenge already used")
+        self._seen[nonce] = float(expiry)
+
+    def _prune_seen(self, now: float):
+        if now < self._next_prune:
+            return
+        self._seen = {
+            nonce: expires_at
+            for nonce, expires_at in self._seen.items()
+            if expires_at >= now
+        }
+        self._next_prune = now + 1
+
+
+def _make_challenge_store() -> ChallengeStore:
+    backend = os.getenv("CHALLENGE_STORE", "table")
+    ttl_s = int(os.getenv("CHALLENGE_TTL_S", "300"))
+    if backend == "table":
+        return TableChallengeStore(ttl_s)
+    if backend == "memory":
+        return MemoryChallengeStore(
+            ttl_s, float(os.getenv("CHALLENGE_SWEEP_INTERVAL_S", "30"))
+        )
+    if backend == "redis":
+        return RedisChallengeStore(
+            ttl_s, os.getenv("CHALLENGE_STORE_REDIS_URL", "redis://localhost:6379/0")
+        )
+    if backend == "signed":
+        return SignedChallengeStore(
+            ttl_s, os.getenv("CHALLENGE_SECRET") or str(os.getenv("JWT_SECRET"))
+        )
+    raise ValueError(f"Unknown CHALLENGE_STORE backend {backend!r}")
+
+
+load_dotenv()
+challenge_store = _make_challenge_store()
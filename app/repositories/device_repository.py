@@ -2,19 +2,22 @@ from uuid import UUID
 from datetime import datetime
 
 from sqlalchemy.exc import SQLAlchemyError
-from sqlalchemy import select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import select, update, func
 
 from schemas import ThermostatSchedule
-from models import Device
-from database import get_db
+from models import Device, Report
+from database import use_session
+from repositories.identity_cache import device_cache, public_key_cache
+from realtime.schedules import schedule_notifier
 
 
 class DeviceRepository:
     """Stateless collection of DB access functions for Device model"""
 
     @staticmethod
-    async def create_device(device: Device):
-        async with get_db() as session:
+    async def create_device(device: Device, session: AsyncSession | None = None):
+        async with use_session(session) as session:
             try:
                 session.add(device)
                 await session.commit()
@@ -23,8 +26,10 @@ class DeviceRepository:
                 raise e
 
     @staticmethod
-    async def get_users_devices(user_id: UUID) -> list[Device]:
-        async with get_db() as session:
+    async def get_users_devices(
+        user_id: UUID, session: AsyncSession | None = None
+    ) -> list[Device]:
+        async with use_session(session) as session:
             try:
                 stmt = select(Device).filter(Device.user_id == user_id)
                 result = await session.execute(stmt)
@@ -33,8 +38,8 @@ class DeviceRepository:
                 raise e
 
     @staticmethod
-    async def get_device_by_id(device_id: UUID):
-        async with get_db() as session:
+    async def get_device_by_id(device_id: UUID, session: AsyncSession | None = None):
+        async with use_session(session) as session:
             try:
                 device = await session.get(Device, device_id)
                 if device is not None:
@@ -45,34 +50,66 @@ class DeviceRepository:
                 raise e
 
     @staticmethod
-    async def delete_device_by_id(device_id: UUID):
-        async with get_db() as session:
+    async def get_recently_active_devices(
+        since: datetime, limit: int, session: AsyncSession | None = None
+    ) -> list[Device]:
+        """Devices that reported after `since`, most recent first"""
+        async with use_session(session, read_only=True) as session:
+            try:
+                last_report = (
+                    select(Report.device_id, func.max(Report.timestamp).label("last"))
+                    .filter(Report.timestamp > since)
+                    .group_by(Report.device_id)
+                    .subquery()
+                )
+                stmt = (
+                    select(Device)
+                    .join(last_report, Device.device_id == last_report.c.device_id)
+                    .order_by(last_report.c.last.desc())
+                    .limit(limit)
+                )
+                result = await session.execute(stmt)
+                return result.scalars().all()
+            except SQLAlchemyError as e:
+                raise e
+
+    @staticmethod
+    async def delete_device_by_id(device_id: UUID, session: AsyncSession | None = None):
+        async with use_session(session) as session:
             try:
                 device = await session.get(Device, device_id)
                 if device is None:
                     raise ValueError(f"Device with id {device_id} not found")
                 await session.delete(device)
                 await session.commit()
+                device_cache.invalidate(device_id)
+                public_key_cache.invalidate(device_id)
             except SQLAlchemyError as e:
                 await session.rollback()
                 raise e
 
     @staticmethod
-    async def update_device(device_id: UUID, device: Device):
-        async with get_db() as session:
+    async def update_device(
+        device_id: UUID, device: Device, session: AsyncSession | None = None
+    ):
+        async with use_session(session) as session:
             try:
                 stmt = (
                     update(Device).where(Device.device_id == device_id).values(**device)
                 )
                 await session.execute(stmt)
                 await session.commit()
+                device_cache.invalidate(device_id)
+                public_key_cache.invalidate(device_id)
             except SQLAlchemyError as e:
                 await session.rollback()
                 raise e
 
     @staticmethod
-    async def register_device(device_id: UUID, user_id: UUID):
-        async with get_db() as session:
+    async def register_device(
+        device_id: UUID, user_id: UUID, session: AsyncSession | None = None
+    ):
+        async with use_session(session) as session:
             try:
                 stmt = (
                     update(Device)
@@ -81,13 +118,14 @@ class DeviceRepository:
                 )
                 await session.execute(stmt)
                 await session.commit()
+                device_cache.invalidate(device_id)
             except SQLAlchemyError as e:
                 await session.rollback()
                 raise e
 
     @staticmethod
-    async def unregister_device(device_id: UUID):
-        async with get_db() as session:
+    async def unregister_device(device_id: UUID, session: AsyncSession | None = None):
+        async with use_session(session) as session:
             try:
                 stmt = (
                     update(Device)
@@ -96,15 +134,19 @@ class DeviceRepository:
                 )
                 await session.execute(stmt)
                 await session.commit()
+                device_cache.invalidate(device_id)
             except SQLAlchemyError as e:
                 await session.rollback()
                 raise e
 
     @staticmethod
     async def update_device_schedule(
-        device_id: UUID, schedule: ThermostatSchedule | None
-    ):
-        async with get_db() as session:
+        device_id: UUID,
+        schedule: ThermostatSchedule | None,
+        session: AsyncSession | None = None,
+    ) -> int:
+        """Store the schedule, wake everyone waiting on it, return its new version"""
+        async with use_session(session) as session:
             try:
                 if schedule is None:
                     schedule_json = None
@@ -113,31 +155,45 @@ class DeviceRepository:
                 stmt = (
                     update(Device)
                     .where(Device.device_id == device_id)
-                    .values(schedule=schedule_json)
+                    .values(
+                        schedule=schedule_json,
+                        schedule_version=Device.schedule_version + 1,
+                    )
+                    .returning(Device.schedule_version)
                 )
-                await session.execute(stmt)
+                result = await session.execute(stmt)
+                version = result.scalar_one_or_none()
+                if version is None:
+                    raise ValueError(f"Device with id {device_id} not found")
                 await session.commit()
+                device_cache.invalidate(device_id)
             except SQLAlchemyError as e:
                 await session.rollback()
                 raise e
+        await schedule_notifier.notify(device_id, version, schedule_json)
+        return version
 
     @staticmethod
-    async def get_device_schedule(device_id: UUID):
-        async with get_db() as session:
+    async def get_device_schedule_version(
+        device_id: UUID, session: AsyncSession | None = None
+    ) -> tuple[str | None, int]:
+        """Stored schedule JSON, unparsed, and its version"""
+        async with use_session(session, read_only=True) as session:
             try:
-                stmt = select(Device.schedule).filter(Device.device_id == device_id)
+                stmt = select(Device.schedule, Device.schedule_version).filter(
+                    Device.device_id == device_id
+                )
                 result = await session.execute(stmt)
-                schedule_json = result.scalars().first()
-                try:
-                    return ThermostatSchedule.model_validate_json(schedule_json)
-                except:
-                    return None
+                row = result.first()
+                if row is None:
+                    raise ValueError(f"Device with id {device_id} not found")
+                return row.schedule, row.schedule_version
             except SQLAlchemyError as e:
                 raise e
 
     @staticmethod
-    async def get_all_devices() -> list[Device]:
-        async with get_db() as session:
+    async def get_all_devices(session: AsyncSession | None = None) -> list[Device]:
+        async with use_session(session, read_only=True) as session:
             try:
                 stmt = select(Device)
                 result = await session.execute(stmt)
@@ -0,0 +1,125 @@
+from collections import OrderedDict
+from datetime import datetime
+from uuid import UUID
+from dotenv import load_dotenv
+import os
+import time
+
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from schemas import ThermostatReport
+from repositories.report_repository import ReportRepository
+from realtime import connection_manager
+
+
+class DeviceState:
+    """Last known reading of one device"""
+
+    __slots__ = ("temperature_celcius", "heater_on", "timestamp", "received_at")
+
+    def __init__(
+        self,
+        temperature_celcius: float,
+        heater_on: bool,
+        timestamp: datetime,
+        received_at: datetime | None,
+    ):
+        self.temperature_celcius = temperature_celcius
+        self.heater_on = heater_on
+        self.timestamp = timestamp
+        self.received_at = received_at  # None when seeded from the database
+
+
+class DeviceStateTable:
+    """In-process LRU table of the latest reading per device, fed by the broker"""
+
+    def __init__(self, max_devices: int, ttl_s: float):
+        self.max_devices = max_devices
+        self.ttl = ttl_s
+        # device_id -> (expires_at, state)
+        self._states: OrderedDict[UUID, tuple[float, DeviceState | None]] = (
+            OrderedDict()
+        )
+        self.hits = 0
+        self.misses = 0
+
+    def update(
+        self,
+        device_id: UUID,
+        temperature_celcius: float,
+        heater_on: bool,
+        timestamp: datetime,
+        received_at: datetime | None = None,
+    ):
+        entry = self._states.get(device_id)
+        # reports may arrive out of order, keep the newest reading
+        if (
+            entry is not None
+            and entry[1] is not None
+            and entry[1].timestamp > timestamp
+        ):
+            self._put(device_id, entry[1])
+            return
+        self._put(
+            device_id,
+            DeviceState(
+                temperature_celcius,
+                heater_on,
+                timestamp,
+                received_at or datetime.now(),
+            ),
+        )
+
+    def on_report(self, device_id: str, message: str):
+        """Connection manager listener, `message` is a ThermostatReport as JSON"""
+        report = ThermostatReport.model_validate_json(message)
+        self.update(
+            UUID(device_id),
+            report.temperature_celcius,
+            report.heater_on,
+            report.timestamp,
+        )
+
+    async def get(
+        self, device_id: UUID, session: AsyncSession | None = None
+    ) -> DeviceState | None:
+        entry = self._states.get(device_id)
+        if entry is not None and entry[0] > time.monotonic():
+            self._states.move_to_end(device_id)
+            self.hits += 1
+            return entry[1]
+
+        self.misses += 1
+        report = await ReportRepository.get_latest_device_report(device_id, session)
+        # an update may have landed while the report was being fetched
+        entry = self._states.get(device_id)
+        if entry is None or entry[0] <= time.monotonic():
+            state = None
+            if report is not None:
+                state = DeviceState(
+                    report.temperature_celcius, report.heater_on, report.timestamp, None
+                )
+            self._put(device_id, state)
+        return self._states[device_id][1]
+
+    def _put(self, device_id: UUID, state: DeviceState | None):
+        self._states[device_id] = (time.monotonic() + self.ttl, state)
+        self._states.move_to_end(device_id)
+        while len(self._states) > self.max_devices:
+            self._states.popitem(last=False)
+
+    def stats(self) -> dict:
+        return {
+            "size": len(self._states),
+            "max_devices": self.max_devices,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+load_dotenv()
+device_state = DeviceStateTable(
+    max_devices=int(os.getenv("DEVICE_STATE_MAX_DEVICES", "10000")),
+    ttl_s=float(os.getenv("DEVICE_STATE_TTL_S", "300")),
+)
+connection_manager.add_listener(device_state.on_report)
@@ -0,0 +1,87 @@
+from collections import OrderedDict
+from typing import Any, Generic, Hashable, TypeVar
+from dotenv import load_dotenv
+import os
+import time
+
+from models import User, Device
+
+V = TypeVar("V")
+
+
+class TTLCache(Generic[V]):
+    """In-process LRU cache whose entries also expire after `ttl_s` seconds
+
+    Repositories invalidate entries explicitly when they mutate a row, the
+    TTL only bounds staleness from writes made by other workers.
+    """
+
+    def __init__(self, enabled: bool, max_entries: int, ttl_s: float):
+        self.enabled = enabled
+        self.max_entries = max_entries
+        self.ttl = ttl_s
+        self._entries: OrderedDict[Hashable, tuple[float, V]] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: Hashable) -> V | None:
+        if not self.enabled:
+            return None
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        expires_at, value = entry
+        if expires_at < time.monotonic():
+            del self._entries[key]
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key: Hashable, value: V):
+        if not self.enabled:
+            return
+        self._entries[key] = (time.monotonic() + self.ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, key: Hashable):
+        self._entries.pop(key, None)
+
+    def clear(self):
+        self._entries.clear()
+
+    def stats(self) -> dict:
+        return {
+            "size": len(self._entries),
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
+load_dotenv()
+_enabled = os.getenv("IDENTITY_CACHE_ENABLED", "true").lower() == "true"
+_ttl_s = float(os.getenv("IDENTITY_CACHE_TTL_S", "60"))
+device_cache: TTLCache[Device] = TTLCache(
+    enabled=_enabled,
+    max_entries=int(os.getenv("IDENTITY_CACHE_MAX_DEVICES", "10000")),
+    ttl_s=_ttl_s,
+)
+user_cache: TTLCache[User] = TTLCache(
+    enabled=_enabled,
+    max_entries=int(os.getenv("IDENTITY_CACHE_MAX_USERS", "1000")),
+    ttl_s=_ttl_s,
+)
+# device_id -> (PEM fingerprint, loaded public key)
+public_key_cache: TTLCache[tuple[str, Any]] = TTLCache(
+    enabled=os.getenv("PUBLIC_KEY_CACHE_ENABLED", "true").lower() == "true",
+    max_entries=int(os.getenv("PUBLIC_KEY_CACHE_MAX_KEYS", "10000")),
+    ttl_s=float(os.getenv("PUBLIC_KEY_CACHE_TTL_S", "86400")),
+)
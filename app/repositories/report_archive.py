@@ -0,0 +1,324 @@
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import AsyncIterator
+from uuid import UUID
+from dotenv import load_dotenv
+import asyncio
+import logging
+import os
+import sys
+
+from sqlalchemy import select, delete, func, literal_column
+
+from database import get_db, rows_per_statement
+from models import Report
+from partitioning import month_start
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+except ImportError:
+    pa = None
+
+logger = logging.getLogger(__name__)
+
+# one parameter per report id, plus the device id and the month bounds
+_DELETE_CHUNK_ROWS = rows_per_statement(1, fixed_params=3)
+
+
+class ReportArchive:
+    """Cold storage of old reports as compressed Arrow IPC files
+
+    One file per device per month under `directory`/<device_id>/<YYYY-MM>.arrow.
+    Whole months older than `hot_days` are moved out of the report table by
+    `archive_old_reports`; reads memory-map the files of the months a query
+    touches. Needs the optional `pyarrow` package.
+    """
+
+    def __init__(self, directory: str | None, hot_days: int, interval_s: float):
+        self.enabled = bool(directory)
+        if self.enabled and pa is None:
+            raise RuntimeError("REPORT_ARCHIVE_DIR requires the pyarrow package")
+        self.directory = Path(directory) if directory else None
+        self.hot_days = hot_days
+        self.interval = interval_s
+        self._task: asyncio.Task | None = None
+
+    @property
+    def horizon(self) -> datetime:
+        """Reports before this instant may live in the archive"""
+        return month_start(datetime.now() - timedelta(days=self.hot_days))
+
+    def reaches(self, from_time: datetime | None) -> bool:
+        return self.enabled and (from_time is None or from_time < self.horizon)
+
+    async def start(self):
+        if not self.enabled:
+            return
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    async def _run(self):
+        while True:
+            try:
+                await self.archive_old_reports()
+            except Exception:
+                logger.exception("Failed to archive reports")
+            await asyncio.sleep(self.interval)
+
+    async def archive_old_reports(self) -> int:
+        """Move every device-month before the horizon from report to files"""
+        horizon = self.horizon
+        month = func.date_trunc(literal_column("'month'"), Report.timestamp)
+        async with get_db() as session:
+            result = await session.execute(
+                select(Report.device_id, month)
+                .filter(Report.timestamp < horizon)
+                .group_by(Report.device_id, month)
+            )
+            groups = result.all()
+
+        archived = 0
+        for device_id, month_begin in groups:
+            archived += await self._archive_month(device_id, month_begin)
+        if archived:
+            logger.info("Archived %d reports older than %s", archived, horizon)
+        return archived
+
+    async def _archive_month(self, device_id: UUID, month_begin: datetime) -> int:
+        month_end = month_start(month_begin, 1)
+        in_month = (
+            Report.device_id == device_id,
+            Report.timestamp >= month_begin,
+            Report.timestamp < month_end,
+        )
+        async with get_db() as session:
+            result = await session.execute(select(Report).filter(*in_month))
+            reports = result.scalars().all()
+            if not reports:
+                return 0
+            # the file is durable before the rows go, a crash in between only
+            # leaves duplicates that the next merge drops
+            await asyncio.to_thread(
+                self._merge_into_file, device_id, month_begin, reports
+            )
+            # by id, so reports that arrived since the SELECT stay in the table
+            report_ids = [report.report_id for report in reports]
+            for start in range(0, len(report_ids), _DELETE_CHUNK_ROWS):
+                chunk = report_ids[start : start + _DELETE_CHUNK_ROWS]
+                await session.execute(
+                    delete(Report).filter(*in_month, Report.report_id.in_(chunk))
+                )
+            await session.commit()
+            return len(reports)
+
+    def _path(self, device_id: UUID, month_begin: datetime) -> Path:
+        return self.directory / str(device_id) / f"{month_begin:%Y-%m}.arrow"
+
+    def _merge_into_file(
+        self, device_id: UUID, month_begin: datetime, reports: list[Report]
+    ):
+        path = self._path(device_id, month_begin)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        table = pa.Table.from_pydict(
+            {
+                "report_id": [report.report_id.bytes for report in reports],
+                "user_id": [
+                    report.user_id.bytes if report.user_id else None
+                    for report in reports
+                ],
+                "temperature_celcius": [r.temperature_celcius for r in reports],
+                "heater_on": [report.heater_on for report in reports],
+                "timestamp": [report.timestamp for report in reports],
+            },
+            schema=_SCHEMA,
+        )
+        if path.exists():
+            existing = self._read_file(path)
+            known = pc.is_in(table["report_id"], value_set=existing["report_id"])
+            table = pa.concat_tables([existing, table.filter(pc.invert(known))])
+        table = table.sort_by([("timestamp", "ascending"), ("report_id", "ascending")])
+
+        tmp_path = path.with_suffix(".tmp")
+        options = pa.ipc.IpcWriteOptions(compression="zstd")
+        with pa.OSFile(str(tmp_path), "wb") as sink:
+            with pa.ipc.new_file(sink, _SCHEMA, options=options) as writer:
+                writer.write_table(table)
+        with open(tmp_path, "rb") as f:
+            os.fsync(f.fileno())
+        tmp_path.replace(path)
+
+    @staticmethod
+    def _read_file(path: Path):
+        with pa.memory_map(str(path)) as source:
+            return pa.ipc.open_file(source).read_all()
+
+    async def read(
+        self,
+        device_id: UUID,
+        from_time: datetime | None = None,
+        to_time: datetime | None = None,
+        after: tuple[datetime, UUID] | None = None,
+        limit: int | None = None,
+    ) -> list[Report]:
+        """Archived reports in [from_time, to_time) ordered by (timestamp, report_id)"""
+        reports: list[Report] = []
+        async for month_reports in self.iter_months(
+            device_id, from_time, to_time, after
+        ):
+            reports.extend(month_reports)
+            if limit is not None and len(reports) >= limit:
+                return reports[:limit]
+        return reports
+
+    async def iter_months(
+        self,
+        device_id: UUID,
+        from_time: datetime | None = None,
+        to_time: datetime | None = None,
+        after: tuple[datetime, UUID] | None = None,
+    ) -> AsyncIterator[list[Report]]:
+        """Like `read`, one archived month at a time to bound memory"""
+        if not self.reaches(from_time):
+            return
+        device_dir = self.directory / str(device_id)
+        if not device_dir.is_dir():
+            return
+        first = month_start(from_time) if from_time else None
+        if after is not None:
+            # months before the cursor hold nothing past it, skip their files
+            seek = month_start(after[0])
+            first = max(first, seek) if first else seek
+        for path in sorted(device_dir.glob("*.arrow")):
+            month_begin = datetime.strptime(path.stem, "%Y-%m")
+            if first and month_begin < first:
+                continue
+            if to_time and month_begin >= to_time:
+                break
+            yield await asyncio.to_thread(
+                self._read_month, path, device_id, from_time, to_time, after
+            )
+
+    async def iter_user_months(self, user_id: UUID) -> AsyncIterator[list[Report]]:
+        """Archived reports of the user across all devices, one month at a time"""
+        if not self.enabled or not self.directory.is_dir():
+            return
+        months: dict[str, list[Path]] = {}
+        for path in self.directory.glob("*/*.arrow"):
+            months.setdefault(path.stem, []).append(path)
+        for month in sorted(months):
+            reports = []
+            for path in months[month]:
+                reports.extend(
+                    await asyncio.to_thread(
+                        self._read_month,
+                        path,
+                        UUID(path.parent.name),
+                        user_id=user_id,
+                    )
+                )
+            yield sorted(reports, key=lambda r: (r.timestamp, r.report_id))
+
+    async def latest(self, device_id: UUID) -> Report | None:
+        """Most recent archived report of the device"""
+        if not self.enabled:
+            return None
+        device_dir = self.directory / str(device_id)
+        if not device_dir.is_dir():
+            return None
+        for path in sorted(device_dir.glob("*.arrow"), reverse=True):
+            table = await asyncio.to_thread(self._read_file, path)
+            if table.num_rows:
+                # files are sorted by (timestamp, report_id)
+                return _to_reports(table.slice(table.num_rows - 1), device_id)[0]
+        return None
+
+    def _read_month(
+        self,
+        path,
+        device_id,
+        from_time=None,
+        to_time=None,
+        after=None,
+        user_id=None,
+    ) -> list[Report]:
+        table = self._read_file(path)
+        conditions = []
+        if user_id is not None:
+            conditions.append(pc.equal(table["user_id"], pa.scalar(user_id.bytes)))
+        if from_time is not None:
+            conditions.append(pc.greater_equal(table["timestamp"], from_time))
+        if to_time is not None:
+            conditions.append(pc.less(table["timestamp"], to_time))
+        if after is not None:
+            conditions.append(pc.greater_equal(table["timestamp"], after[0]))
+        if conditions:
+            mask = conditions[0]
+            for condition in conditions[1:]:
+                mask = pc.and_(mask, condition)
+            table = table.filter(mask)
+
+        return [
+            report
+            for report in _to_reports(table, device_id)
+            if not after or (report.timestamp, report.report_id) > after
+        ]
+
+
+def _to_reports(table, device_id: UUID) -> list[Report]:
+    return [
+        Report(
+            report_id=UUID(bytes=row["report_id"]),
+            user_id=UUID(bytes=row["user_id"]) if row["user_id"] else None,
+            device_id=device_id,
+            temperature_celcius=row["temperature_celcius"],
+            heater_on=row["heater_on"],
+            timestamp=row["timestamp"],
+        )
+        for row in table.to_pylist()
+    ]
+
+
+if pa is not None:
+    _SCHEMA = pa.schema(
+        [
+            ("report_id", pa.binary(16)),
+            ("user_id", pa.binary(16)),
+            ("temperature_celcius", pa.float64()),
+            ("heater_on", pa.bool_()),
+            ("timestamp", pa.timestamp("us")),
+        ]
+    )
+
+
+def merge_reports(
+    archived: list[Report], hot: list[Report], limit: int | None = None
+) -> list[Report]:
+    """Merge two (timestamp, report_id) ordered lists, keeping at most `limit`"""
+    if not archived:
+        return hot
+    merged = sorted(archived + hot, key=lambda r: (r.timestamp, r.report_id))
+    return merged[:limit] if limit is not None else merged
+
+
+load_dotenv()
+report_archive = ReportArchive(
+    directory=os.getenv("REPORT_ARCHIVE_DIR"),
+    hot_days=int(os.getenv("REPORT_ARCHIVE_HOT_DAYS", "90")),
+    interval_s=float(os.getenv("REPORT_ARCHIVE_INTERVAL_S", "86400")),
+)
+
+if __name__ == "__main__":
+    if sys.argv[1:] != ["run"]:
+        sys.exit("usage: python -m repositories.report_archive run")
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(report_archive.archive_old_reports())
@@ -0,0 +1,149 @@
+from enum import Enum
+from typing import Awaitable, Callable
+from dotenv import load_dotenv
+import asyncio
+import logging
+import os
+
+from models import Report
+
+logger = logging.getLogger(__name__)
+
+
+class Durability(str, Enum):
+    FLUSH = "flush"  # ack once the report is committed
+    ENQUEUE = "enqueue"  # ack once the report is buffered
+
+
+class ReportIngestBuffer:
+    """Write-behind buffer coalescing single reports into bulk inserts
+
+    Reports are queued in memory and a background flusher writes them in
+    batches of up to `max_batch_rows`, waiting at most `flush_interval_ms`
+    after the first report of a batch. The queue is bounded by
+    `max_pending`; once full, submitters wait until the flusher catches up.
+    """
+
+    def __init__(
+        self,
+        enabled: bool,
+        flush_interval_ms: int,
+        max_batch_rows: int,
+        max_pending: int,
+        durability: Durability,
+    ):
+        self.enabled = enabled
+        self.flush_interval = flush_interval_ms / 1000
+        self.max_batch_rows = max_batch_rows
+        self.durability = durability
+        self._queue: asyncio.Queue[tuple[Report, asyncio.Future | None]] = (
+            asyncio.Queue(maxsize=max_pending)
+        )
+        self._writer: Callable[[list[Report]], Awaitable[None]] | None = None
+        self._task: asyncio.Task | None = None
+        self._closing = False
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._closing
+
+    async def start(self, writer: Callable[[list[Report]], Awaitable[None]]):
+        if not self.enabled:
+            return
+        self._writer = writer
+        self._closing = False
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Stop accepting reports and flush everything still queued"""
+        if self._task is None:
+            return
+        self._closing = True
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+        batch = []
+        while not self._queue.empty():
+            batch.append(self._queue.get_nowait())
+            if len(batch) >= self.max_batch_rows:
+                await self._flush(batch)
+                batch = []
+        await self._flush(batch)
+
+    async def submit(self, report: Report):
+        if not self.running:
+            raise RuntimeError("Report ingest buffer is not running")
+
+        future = None
+        if self.durability == Durability.FLUSH:
+            future = asyncio.get_running_loop().create_future()
+        await self._queue.put((report, future))
+        if future is not None:
+            await future
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.flush_interval
+            try:
+                while len(batch) < self.max_batch_rows:
+                    try:
+                        batch.append(self._queue.get_nowait())
+                        continue
+                    except asyncio.QueueEmpty:
+                        pass
+                    remaining = deadline - loop.time()
+                    if remaining <= 0:
+                        break
+                    try:
+                        batch.append(
+                            await asyncio.wait_for(self._queue.get(), remaining)
+                        )
+                    except asyncio.TimeoutError:
+                        break
+            finally:
+                # flush what was collected even when cancelled during shutdown
+                await asyncio.shield(self._flush(batch))
+
+    async def _flush(self, batch: list[tuple[Report, asyncio.Future | None]]):
+        if not batch:
+            return
+        try:
+            await self._writer([report for report, _ in batch])
+            error = None
+        except Exception as e:
+            error = e
+        if error is None:
+            for _, future in batch:
+                if future is not None and not future.done():
+                    future.set_result(None)
+            return
+
+        if len(batch) == 1:
+            logger.error("Failed to write a buffered report", exc_info=error)
+            _, future = batch[0]
+            if future is not None and not future.done():
+                future.set_exception(error)
+            return
+        # bisect so only the submitters of the offending rows get the error
+        logger.warning(
+            "Failed to flush %d buffered reports, retrying in halves", len(batch)
+        )
+        middle = len(batch) // 2
+        await self._flush(batch[:middle])
+        await self._flush(batch[middle:])
+
+
+load_dotenv()
+report_ingest = ReportIngestBuffer(
+    enabled=os.getenv("REPORT_INGEST_ENABLED", "true").lower() == "true",
+    flush_interval_ms=int(os.getenv("REPORT_INGEST_FLUSH_MS", "50")),
+    max_batch_rows=int(os.getenv("REPORT_INGEST_BATCH_ROWS", "500")),
+    max_pending=int(os.getenv("REPORT_INGEST_MAX_PENDING", "10000")),
+    durability=Durability(os.getenv("REPORT_INGEST_DURABILITY", "flush")),
+)
@@ -0,0 +1,160 @@
+from datetime import datetime
+from dotenv import load_dotenv
+import asyncio
+import logging
+import os
+import sys
+
+from sqlalchemy import text
+
+from database import get_db
+from models import Report
+from partitioning import (
+    REPORT_PARTITIONING,
+    REPORT_PARTITION_MONTHS_AHEAD,
+    report_relkind,
+    create_partitioned_report,
+    ensure_month_partition,
+    ensure_month_partitions,
+    month_start,
+)
+
+logger = logging.getLogger(__name__)
+
+
+class ReportPartitionMaintainer:
+    """Background task keeping monthly report partitions created ahead of time
+
+    Rows are never routed to a missing month because partitions exist
+    `months_ahead` months in advance; the default partition only catches
+    timestamps far outside that window.
+    """
+
+    def __init__(self, enabled: bool, months_ahead: int, check_interval_s: float):
+        self.enabled = enabled
+        self.months_ahead = months_ahead
+        self.check_interval = check_interval_s
+        self._task: asyncio.Task | None = None
+
+    async def start(self):
+        if not self.enabled:
+            return
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    async def ensure_partitions(self):
+        async with get_db() as session:
+            if await report_relkind(session) != "p":
+                return
+        now = datetime.now()
+        month, last = month_start(now), month_start(now, self.months_ahead)
+        # one transaction per month so a failing month does not hold back the rest
+        while month <= last:
+            try:
+                async with get_db() as session:
+                    await ensure_month_partition(session, month)
+                    await session.commit()
+            except Exception:
+                logger.exception("Failed to create the report partition of %s", month)
+            month = month_start(month, 1)
+
+    async def _run(self):
+        while True:
+            try:
+                await self.ensure_partitions()
+            except Exception:
+                logger.exception("Failed to create report partitions")
+            await asyncio.sleep(self.check_interval)
+
+
+async def migrate_to_partitioned():
+    """Convert a plain report table into a partitioned one, keeping its rows
+
+    The old table is kept as report_legacy and can be dropped once checked.
+    Runs in one transaction, so writes to report block until it commits.
+    """
+    async with get_db() as session:
+        relkind = await report_relkind(session)
+        if relkind != "r":
+            logger.info("report is not a plain table, nothing to migrate")
+            return
+
+        await session.execute(text("LOCK TABLE report IN ACCESS EXCLUSIVE MODE"))
+        await session.execute(text("ALTER TABLE report RENAME TO report_legacy"))
+        await session.execute(
+            text(
+                "ALTER TABLE report_legacy RENAME CONSTRAINT report_pkey TO report_legacy_pkey"
+            )
+        )
+        for index in Report.__table__.indexes:
+            await session.execute(text(f"DROP INDEX IF EXISTS {index.name}"))
+
+        await create_partitioned_report(session)
+        result = await session.execute(
+            text("SELECT min(timestamp), max(timestamp) FROM report_legacy")
+        )
+        first, last = result.one()
+        now = datetime.now()
+        first = min(first or now, now)
+        last = max(last or now, month_start(now, REPORT_PARTITION_MONTHS_AHEAD))
+        await ensure_month_partitions(session, first, last)
+
+        columns = ", ".join(column.name for column in Report.__table__.columns)
+        await session.execute(
+            text(f"INSERT INTO report ({columns}) SELECT {columns} FROM report_legacy")
+        )
+        for index in Report.__table__.indexes:
+            columns = ", ".join(column.name for column in index.columns)
+            await session.execute(
+                text(f"CREATE INDEX {index.name} ON report ({columns})")
+            )
+        await session.commit()
+        logger.info("Migrated report to monthly partitions from %s to %s", first, last)
+
+
+async def create_report_indexes():
+    """Build the report indexes missing from an existing plain table
+
+    CONCURRENTLY keeps inserts flowing during the build but cannot run in a
+    transaction. A partitioned report gets its indexes when it is created.
+    """
+    async with get_db() as session:
+        if await report_relkind(session) != "r":
+            logger.info("report is not a plain table, nothing to index")
+            return
+        conn = await session.connection(
+            execution_options={"isolation_level": "AUTOCOMMIT"}
+        )
+        for index in Report.__table__.indexes:
+            columns = ", ".join(column.name for column in index.columns)
+            logger.info("Building %s", index.name)
+            await conn.execute(
+                text(
+                    f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {index.name} "
+                    f"ON report ({columns})"
+                )
+            )
+
+
+load_dotenv()
+report_partitions = ReportPartitionMaintainer(
+    enabled=REPORT_PARTITIONING,
+    months_ahead=REPORT_PARTITION_MONTHS_AHEAD,
+    check_interval_s=float(os.getenv("REPORT_PARTITION_CHECK_S", "3600")),
+)
+
+if __name__ == "__main__":
+    commands = {"migrate": migrate_to_partitioned, "indexes": create_report_indexes}
+    if len(sys.argv) != 2 or sys.argv[1] not in commands:
+        sys.exit("usage: python -m repositories.report_partitions migrate|indexes")
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(commands[sys.argv[1]]())
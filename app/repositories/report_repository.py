@@ -1,29 +1,110 @@
-from datetime import datetime
-from uuid import UUID
+from datetime import datetime, timedelta
+from typing import AsyncIterator
+from uuid import UUID, uuid4
 
 from sqlalchemy.exc import SQLAlchemyError
-from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import (
+    select,
+    insert,
+    tuple_,
+    func,
+    case,
+    cast,
+    literal_column,
+    Float,
+)
 
-from database import get_db
+from database import use_session, rows_per_statement
 from models import Report
+from repositories.report_ingest import report_ingest
+from repositories.report_archive import report_archive, merge_reports
+from repositories.report_rollups import (
+    REPORT_ROLLUPS_ENABLED,
+    ROLLUPS,
+    is_aligned,
+    upsert_rollups,
+)
+
+
+# bucket name -> SQL expression truncating Report.timestamp to the bucket start,
+# constants are inlined so GROUP BY matches the SELECT expression exactly
+REPORT_BUCKETS = {
+    "5m": func.to_timestamp(
+        func.floor(func.extract("epoch", Report.timestamp) / literal_column("300"))
+        * literal_column("300")
+    ).op("AT TIME ZONE")(literal_column("'UTC'")),
+    "1h": func.date_trunc(literal_column("'hour'"), Report.timestamp),
+    "1d": func.date_trunc(literal_column("'day'"), Report.timestamp),
+}
+
+_EPOCH = datetime(1970, 1, 1)
+_FIVE_MINUTES = timedelta(minutes=5)
+
+# the same buckets for archived reports, which are aggregated in Python
+_BUCKET_START = {
+    "5m": lambda ts: _EPOCH + (ts - _EPOCH) // _FIVE_MINUTES * _FIVE_MINUTES,
+    "1h": lambda ts: ts.replace(minute=0, second=0, microsecond=0),
+    "1d": lambda ts: ts.replace(hour=0, minute=0, second=0, microsecond=0),
+}
+
+_STREAM_BATCH_ROWS = 1000
+
+_INSERT_CHUNK_ROWS = rows_per_statement(len(Report.__table__.columns))
+
+
+def _report_row(report: Report) -> dict:
+    return {
+        "report_id": report.report_id or uuid4(),
+        "user_id": report.user_id,
+        "device_id": report.device_id,
+        "temperature_celcius": report.temperature_celcius,
+        "heater_on": report.heater_on,
+        "timestamp": report.timestamp,
+    }
 
 
 class ReportRepository:
     """Stateless collection of DB access functions for Report model"""
 
     @staticmethod
-    async def create_report(report: Report):
-        async with get_db() as session:
+    async def create_report(report: Report, session: AsyncSession | None = None):
+        if report_ingest.running:
+            await report_ingest.submit(report)
+            return
+        async with use_session(session) as session:
             try:
                 session.add(report)
+                await upsert_rollups(session, [report])
                 await session.commit()
             except SQLAlchemyError as e:
                 await session.rollback()
                 raise e
 
     @staticmethod
-    async def get_user_reports(user_id: UUID) -> list[Report]:
-        async with get_db() as session:
+    async def create_reports(
+        reports: list[Report], session: AsyncSession | None = None
+    ):
+        """Insert many reports in one transaction using multi-row INSERTs"""
+        if not reports:
+            return
+        rows = [_report_row(report) for report in reports]
+        async with use_session(session) as session:
+            try:
+                for start in range(0, len(rows), _INSERT_CHUNK_ROWS):
+                    chunk = rows[start : start + _INSERT_CHUNK_ROWS]
+                    await session.execute(insert(Report).values(chunk))
+                await upsert_rollups(session, reports)
+                await session.commit()
+            except SQLAlchemyError as e:
+                await session.rollback()
+                raise e
+
+    @staticmethod
+    async def get_user_reports(
+        user_id: UUID, session: AsyncSession | None = None
+    ) -> list[Report]:
+        async with use_session(session, read_only=True) as session:
             try:
                 stmt = select(Report).filter(Report.user_id == user_id)
                 result = await session.execute(stmt)
@@ -31,11 +112,69 @@ class ReportRepository:
             except SQLAlchemyError as e:
                 raise e
 
+    @staticmethod
+    async def stream_user_reports(
+        user_id: UUID, session: AsyncSession | None = None
+    ) -> AsyncIterator[Report]:
+        """Every report of the user, fetched through a server-side cursor
+
+        Archived months come first, then the rows still in the report table.
+        """
+        async for month_reports in report_archive.iter_user_months(user_id):
+            for report in month_reports:
+                yield report
+
+        stmt = select(Report).filter(Report.user_id == user_id)
+        async for report in ReportRepository._stream(stmt, session):
+            yield report
+
+    @staticmethod
+    async def stream_device_reports(
+        device_id: UUID,
+        from_time: datetime | None = None,
+        to_time: datetime | None = None,
+        session: AsyncSession | None = None,
+    ) -> AsyncIterator[Report]:
+        """Device reports in [from_time, to_time), fetched through a server-side cursor
+
+        Archived months come first, then the rows still in the report table.
+        """
+        async for month_reports in report_archive.iter_months(
+            device_id, from_time, to_time
+        ):
+            for report in month_reports:
+                yield report
+
+        stmt = select(Report).filter(Report.device_id == device_id)
+        if from_time is not None:
+            stmt = stmt.filter(Report.timestamp >= from_time)
+        if to_time is not None:
+            stmt = stmt.filter(Report.timestamp < to_time)
+        async for report in ReportRepository._stream(stmt, session):
+            yield report
+
+    @staticmethod
+    async def _stream(stmt, session: AsyncSession | None) -> AsyncIterator[Report]:
+        # only _STREAM_BATCH_ROWS rows are held in memory at a time
+        stmt = stmt.order_by(Report.timestamp).execution_options(
+            yield_per=_STREAM_BATCH_ROWS
+        )
+        async with use_session(session, read_only=True) as session:
+            try:
+                result = await session.stream_scalars(stmt)
+                async for report in result:
+                    yield report
+            except SQLAlchemyError as e:
+                raise e
+
     @staticmethod
     async def get_user_device_reports_after_time(
-        user_id: UUID, device_id: UUID, after_time: datetime
+        user_id: UUID,
+        device_id: UUID,
+        after_time: datetime,
+        session: AsyncSession | None = None,
     ) -> list[Report]:
-        async with get_db() as session:
+        async with use_session(session, read_only=True) as session:
             try:
                 stmt = select(Report).filter(
                     Report.user_id == user_id,
@@ -43,16 +182,200 @@ class ReportRepository:
                     Report.timestamp > after_time,
                 )
                 result = await session.execute(stmt)
-                return result.scalars().all()
+                reports = result.scalars().all()
+            except SQLAlchemyError as e:
+                raise e
+        archived = [
+            report
+            for report in await report_archive.read(device_id, after_time)
+            if report.user_id == user_id and report.timestamp > after_time
+        ]
+        return merge_reports(archived, reports)
+
+    @staticmethod
+    async def get_latest_device_report(
+        device_id: UUID, session: AsyncSession | None = None
+    ) -> Report | None:
+        async with use_session(session, read_only=True) as session:
+            try:
+                stmt = (
+                    select(Report)
+                    .filter(Report.device_id == device_id)
+                    .order_by(Report.timestamp.desc())
+                    .limit(1)
+                )
+                result = await session.execute(stmt)
+                report = result.scalars().first()
             except SQLAlchemyError as e:
                 raise e
+        if report is None:
+            report = await report_archive.latest(device_id)
+        return report
 
     @staticmethod
-    async def get_device_reports(device_id: UUID) -> list[Report]:
-        async with get_db() as session:
+    async def get_device_reports(
+        device_id: UUID,
+        session: AsyncSession | None = None,
+        from_time: datetime | None = None,
+        to_time: datetime | None = None,
+        after: tuple[datetime, UUID] | None = None,
+        limit: int | None = None,
+    ) -> list[Report]:
+        """Device reports in [from_time, to_time) ordered by (timestamp, report_id)
+
+        `after` is the (timestamp, report_id) of the last row of the previous
+        page; seeking past it on the index keeps deep pages as cheap as the
+        first one. Archived months are merged in when the range reaches them.
+        """
+        async with use_session(session, read_only=True) as session:
             try:
                 stmt = select(Report).filter(Report.device_id == device_id)
+                if from_time is not None:
+                    stmt = stmt.filter(Report.timestamp >= from_time)
+                if to_time is not None:
+                    stmt = stmt.filter(Report.timestamp < to_time)
+                if after is not None:
+                    stmt = stmt.filter(
+                        tuple_(Report.timestamp, Report.report_id) > tuple_(*after)
+                    )
+                stmt = stmt.order_by(Report.timestamp, Report.report_id)
+                if limit is not None:
+                    stmt = stmt.limit(limit)
                 result = await session.execute(stmt)
-                return result.scalars().all()
+                reports = result.scalars().all()
+            except SQLAlchemyError as e:
+                raise e
+        archived = await report_archive.read(
+            device_id, from_time, to_time, after, limit
+        )
+        return merge_reports(archived, reports, limit)
+
+    @staticmethod
+    async def aggregate_device_reports(
+        device_id: UUID,
+        bucket: str,
+        from_time: datetime | None = None,
+        to_time: datetime | None = None,
+        session: AsyncSession | None = None,
+    ):
+        """Per-bucket count, min/max/avg temperature and heater-on fraction
+
+        Served from the matching rollup table when the range is aligned to
+        the bucket, so edge buckets are not counted whole, else from report
+        and the archived months the range reaches.
+        """
+        if REPORT_ROLLUPS_ENABLED and bucket in ROLLUPS:
+            model, grain = ROLLUPS[bucket]
+            if is_aligned(from_time, grain) and is_aligned(to_time, grain):
+                return await ReportRepository._aggregate_from_rollup(
+                    model, device_id, from_time, to_time, session
+                )
+
+        bucket_start = REPORT_BUCKETS[bucket].label("bucket_start")
+        async with use_session(session, read_only=True) as session:
+            try:
+                stmt = select(
+                    bucket_start,
+                    func.count().label("count"),
+                    func.min(Report.temperature_celcius).label(
+                        "min_temperature_celcius"
+                    ),
+                    func.max(Report.temperature_celcius).label(
+                        "max_temperature_celcius"
+                    ),
+                    func.avg(Report.temperature_celcius).label(
+                        "avg_temperature_celcius"
+                    ),
+                    func.avg(case((Report.heater_on, 1.0), else_=0.0)).label(
+                        "heater_on_fraction"
+                    ),
+                ).filter(Report.device_id == device_id)
+                if from_time is not None:
+                    stmt = stmt.filter(Report.timestamp >= from_time)
+                if to_time is not None:
+                    stmt = stmt.filter(Report.timestamp < to_time)
+                stmt = stmt.group_by(bucket_start).order_by(bucket_start)
+                result = await session.execute(stmt)
+                rows = result.all()
+            except SQLAlchemyError as e:
+                raise e
+        if not report_archive.reaches(from_time):
+            return rows
+        return await ReportRepository._merge_archived_buckets(
+            rows, device_id, bucket, from_time, to_time
+        )
+
+    @staticmethod
+    async def _merge_archived_buckets(
+        rows,
+        device_id: UUID,
+        bucket: str,
+        from_time: datetime | None,
+        to_time: datetime | None,
+    ) -> list[dict]:
+        # bucket start -> [count, min, max, temperature sum, heater-on count]
+        buckets = {
+            row.bucket_start: [
+                row.count,
+                row.min_temperature_celcius,
+                row.max_temperature_celcius,
+                row.avg_temperature_celcius * row.count,
+                row.heater_on_fraction * row.count,
+            ]
+            for row in rows
+        }
+        async for month_reports in report_archive.iter_months(
+            device_id, from_time, to_time
+        ):
+            for report in month_reports:
+                temperature = report.temperature_celcius
+                start = _BUCKET_START[bucket](report.timestamp)
+                entry = buckets.setdefault(start, [0, temperature, temperature, 0, 0])
+                entry[0] += 1
+                entry[1] = min(entry[1], temperature)
+                entry[2] = max(entry[2], temperature)
+                entry[3] += temperature
+                entry[4] += report.heater_on
+        return [
+            {
+                "bucket_start": start,
+                "count": count,
+                "min_temperature_celcius": low,
+                "max_temperature_celcius": high,
+                "avg_temperature_celcius": total / count,
+                "heater_on_fraction": heater_on / count,
+            }
+            for start, (count, low, high, total, heater_on) in sorted(buckets.items())
+        ]
+
+    @staticmethod
+    async def _aggregate_from_rollup(
+        model,
+        device_id: UUID,
+        from_time: datetime | None,
+        to_time: datetime | None,
+        session: AsyncSession | None,
+    ):
+        async with use_session(session, read_only=True) as session:
+            try:
+                stmt = select(
+                    model.bucket_start,
+                    model.count,
+                    model.temperature_min.label("min_temperature_celcius"),
+                    model.temperature_max.label("max_temperature_celcius"),
+                    (model.temperature_sum / model.count).label(
+                        "avg_temperature_celcius"
+                    ),
+                    (cast(model.heater_on_count, Float) / model.count).label(
+                        "heater_on_fraction"
+                    ),
+                ).filter(model.device_id == device_id)
+                if from_time is not None:
+                    stmt = stmt.filter(model.bucket_start >= from_time)
+                if to_time is not None:
+                    stmt = stmt.filter(model.bucket_start < to_time)
+                stmt = stmt.order_by(model.bucket_start)
+                result = await session.execute(stmt)
+                return result.all()
             except SQLAlchemyError as e:
                 raise e
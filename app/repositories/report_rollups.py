@@ -0,0 +1,156 @@
+from datetime import datetime
+from dotenv import load_dotenv
+import asyncio
+import logging
+import os
+import sys
+
+from sqlalchemy import select, delete, func, case, literal_column, text
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from database import get_db, rows_per_statement
+from models import Report, ReportRollupHour, ReportRollupDay
+from repositories.report_archive import report_archive
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+REPORT_ROLLUPS_ENABLED = os.getenv("REPORT_ROLLUPS_ENABLED", "true").lower() == "true"
+
+_UPSERT_CHUNK_ROWS = rows_per_statement(len(ReportRollupHour.__table__.columns))
+
+# rollup table per aggregate bucket, with the grain it truncates timestamps to
+ROLLUPS = {
+    "1h": (ReportRollupHour, "hour"),
+    "1d": (ReportRollupDay, "day"),
+}
+
+
+def _truncate(timestamp: datetime, grain: str) -> datetime:
+    timestamp = timestamp.replace(minute=0, second=0, microsecond=0)
+    if grain == "day":
+        timestamp = timestamp.replace(hour=0)
+    return timestamp
+
+
+def is_aligned(timestamp: datetime | None, grain: str) -> bool:
+    return timestamp is None or _truncate(timestamp, grain) == timestamp
+
+
+async def upsert_rollups(session: AsyncSession, reports: list[Report]):
+    """Add a batch of new reports to every rollup table
+
+    Runs in the caller's transaction so rollups commit together with the
+    reports. The batch is pre-aggregated per bucket since one INSERT ... ON
+    CONFLICT cannot touch the same row twice.
+    """
+    if not REPORT_ROLLUPS_ENABLED or not reports:
+        return
+    for model, grain in ROLLUPS.values():
+        buckets: dict[tuple, dict] = {}
+        for report in reports:
+            key = (report.device_id, _truncate(report.timestamp, grain))
+            row = buckets.get(key)
+            if row is None:
+                buckets[key] = {
+                    "device_id": key[0],
+                    "bucket_start": key[1],
+                    "count": 1,
+                    "temperature_sum": report.temperature_celcius,
+                    "temperature_min": report.temperature_celcius,
+                    "temperature_max": report.temperature_celcius,
+                    "heater_on_count": int(report.heater_on),
+                }
+                continue
+            row["count"] += 1
+            row["temperature_sum"] += report.temperature_celcius
+            row["temperature_min"] = min(
+                row["temperature_min"], report.temperature_celcius
+            )
+            row["temperature_max"] = max(
+                row["temperature_max"], report.temperature_celcius
+            )
+            row["heater_on_count"] += int(report.heater_on)
+
+        # a stable row order keeps concurrent upserts from deadlocking
+        rows = [
+            buckets[key]
+            for key in sorted(buckets, key=lambda k: (str(k[0]), k[1].isoformat()))
+        ]
+        for start in range(0, len(rows), _UPSERT_CHUNK_ROWS):
+            await _upsert_chunk(
+                session, model, rows[start : start + _UPSERT_CHUNK_ROWS]
+            )
+
+
+async def _upsert_chunk(session: AsyncSession, model, rows: list[dict]):
+    stmt = insert(model).values(rows)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[model.device_id, model.bucket_start],
+        set_={
+            "count": model.count + stmt.excluded.count,
+            "temperature_sum": model.temperature_sum + stmt.excluded.temperature_sum,
+            "temperature_min": func.least(
+                model.temperature_min, stmt.excluded.temperature_min
+            ),
+            "temperature_max": func.greatest(
+                model.temperature_max, stmt.excluded.temperature_max
+            ),
+            "heater_on_count": model.heater_on_count + stmt.excluded.heater_on_count,
+        },
+    )
+    await session.execute(stmt)
+
+
+async def backfill_rollups():
+    """Rebuild every rollup table from the rows currently in report
+
+    Inserts into report are blocked while this runs so no report is counted
+    twice or missed. When the archive is enabled, buckets before its horizon
+    are left alone since their reports may only exist in the archive files.
+    """
+    horizon = report_archive.horizon if report_archive.enabled else None
+    async with get_db() as session:
+        await session.execute(text("LOCK TABLE report IN SHARE MODE"))
+        for model, grain in ROLLUPS.values():
+            bucket_start = func.date_trunc(
+                literal_column(f"'{grain}'"), Report.timestamp
+            )
+            rows = select(
+                Report.device_id,
+                bucket_start,
+                func.count(),
+                func.sum(Report.temperature_celcius),
+                func.min(Report.temperature_celcius),
+                func.max(Report.temperature_celcius),
+                func.sum(case((Report.heater_on, 1), else_=0)),
+            ).group_by(Report.device_id, bucket_start)
+            stale = delete(model)
+            if horizon is not None:
+                rows = rows.filter(Report.timestamp >= horizon)
+                stale = stale.filter(model.bucket_start >= horizon)
+            await session.execute(stale)
+            await session.execute(
+                insert(model).from_select(
+                    [
+                        "device_id",
+                        "bucket_start",
+                        "count",
+                        "temperature_sum",
+                        "temperature_min",
+                        "temperature_max",
+                        "heater_on_count",
+                    ],
+                    rows,
+                )
+            )
+            logger.info("Rebuilt %s", model.__tablename__)
+        await session.commit()
+
+
+if __name__ == "__main__":
+    if sys.argv[1:] != ["backfill"]:
+        sys.exit("usage: python -m repositories.report_rollups backfill")
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(backfill_rollups())
@@ -0,0 +1,132 @@
+from datetime import datetime, timedelta
+from typing import Callable
+from dotenv import load_dotenv
+import asyncio
+import logging
+import os
+import sys
+
+from sqlalchemy import select, delete
+from sqlalchemy.sql import ColumnElement
+
+from database import get_db
+from models import Report, Challenge
+
+logger = logging.getLogger(__name__)
+
+
+class RetentionPolicy:
+    """Rows of `model` matching `condition()` are expired and get deleted"""
+
+    def __init__(self, name: str, model, condition: Callable[[], ColumnElement]):
+        self.name = name
+        self.model = model
+        self.condition = condition
+
+
+class RetentionEngine:
+    """Deletes expired rows in small batches with pauses in between
+
+    Each batch is its own short transaction, so row locks are held briefly
+    and autovacuum gets to keep up instead of facing one huge delete.
+    """
+
+    def __init__(
+        self,
+        enabled: bool,
+        policies: list[RetentionPolicy],
+        batch_rows: int,
+        pause_ms: int,
+        interval_s: float,
+    ):
+        self.enabled = enabled
+        self.policies = policies
+        self.batch_rows = batch_rows
+        self.pause = pause_ms / 1000
+        self.interval = interval_s
+        self._task: asyncio.Task | None = None
+
+    async def start(self):
+        if not self.enabled:
+            return
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    async def _run(self):
+        while True:
+            try:
+                await self.run_once()
+            except Exception:
+                logger.exception("Retention run failed")
+            await asyncio.sleep(self.interval)
+
+    async def run_once(self) -> dict[str, int]:
+        removed = {}
+        for policy in self.policies:
+            removed[policy.name] = await self._apply(policy)
+            logger.info(
+                "Retention removed %d %s rows", removed[policy.name], policy.name
+            )
+        return removed
+
+    async def _apply(self, policy: RetentionPolicy) -> int:
+        (primary_key,) = policy.model.__table__.primary_key.columns
+        # evaluated once per run so the cutoff does not move between batches
+        condition = policy.condition()
+        removed = 0
+        while True:
+            batch = (
+                select(primary_key).filter(condition).limit(self.batch_rows)
+            ).scalar_subquery()
+            async with get_db() as session:
+                result = await session.execute(
+                    delete(policy.model).where(primary_key.in_(batch))
+                )
+                await session.commit()
+            removed += result.rowcount
+            if result.rowcount < self.batch_rows:
+                return removed
+            await asyncio.sleep(self.pause)
+
+
+def _make_policies() -> list[RetentionPolicy]:
+    policies = [
+        RetentionPolicy(
+            "challenge", Challenge, lambda: Challenge.expires_at < datetime.now()
+        )
+    ]
+    report_days = int(os.getenv("RETENTION_REPORT_DAYS", "0"))
+    if report_days > 0:
+        policies.append(
+            RetentionPolicy(
+                "report",
+                Report,
+                lambda: Report.timestamp < datetime.now() - timedelta(days=report_days),
+            )
+        )
+    return policies
+
+
+load_dotenv()
+retention = RetentionEngine(
+    enabled=os.getenv("RETENTION_ENABLED", "true").lower() == "true",
+    policies=_make_policies(),
+    batch_rows=int(os.getenv("RETENTION_BATCH_ROWS", "1000")),
+    pause_ms=int(os.getenv("RETENTION_PAUSE_MS", "200")),
+    interval_s=float(os.getenv("RETENTION_INTERVAL_S", "3600")),
+)
+
+if __name__ == "__main__":
+    if sys.argv[1:] != ["run"]:
+        sys.exit("usage: python -m repositories.retention run")
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(retention.run_once())
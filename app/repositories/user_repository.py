@@ -1,9 +1,11 @@
 from uuid import UUID
 
 from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import select
 
-from database import get_db
+from database import use_session
+from repositories.identity_cache import user_cache
 from models import User
 
 
@@ -11,8 +13,8 @@ class UserRepository:
     """Stateless collection of DB access functions for User model"""
 
     @staticmethod
-    async def create_user(user: User):
-        async with get_db() as session:
+    async def create_user(user: User, session: AsyncSession | None = None):
+        async with use_session(session) as session:
             try:
                 session.add(user)
                 await session.commit()
@@ -21,8 +23,8 @@ class UserRepository:
                 raise e
 
     @staticmethod
-    async def get_user_by_email(email: str):
-        async with get_db() as session:
+    async def get_user_by_email(email: str, session: AsyncSession | None = None):
+        async with use_session(session) as session:
             try:
                 stmt = select(User).filter_by(email=email)
                 result = await session.execute(stmt)
@@ -34,8 +36,10 @@ class UserRepository:
                 raise e
 
     @staticmethod
-    async def get_user_by_id(user_id: UUID) -> User:
-        async with get_db() as session:
+    async def get_user_by_id(
+        user_id: UUID, session: AsyncSession | None = None
+    ) -> User:
+        async with use_session(session) as session:
             try:
                 user = await session.get(User, user_id)
                 if user is not None:
@@ -45,8 +49,8 @@ class UserRepository:
                 raise e
 
     @staticmethod
-    async def get_all_users() -> list[User]:
-        async with get_db() as session:
+    async def get_all_users(session: AsyncSession | None = None) -> list[User]:
+        async with use_session(session, read_only=True) as session:
             try:
                 stmt = select(User)
                 result = await session.execute(stmt)
@@ -55,20 +59,21 @@ class UserRepository:
                 raise e
 
     @staticmethod
-    async def delete_user_by_id(user_id: UUID):
-        async with get_db() as session:
+    async def delete_user_by_id(user_id: UUID, session: AsyncSession | None = None):
+        async with use_session(session) as session:
             try:
                 user = await session.get(User, user_id)
                 if user is None:
                     raise ValueError(f"User with id {user_id} not found")
                 await session.delete(user)
                 await session.commit()
+                user_cache.invalidate(user_id)
             except SQLAlchemyError as e:
                 await session.rollback()
                 raise e
 
     # async def update_user(self, user_id: UUID, user: User):
-    #     async with get_db() as session:
+    #     async with use_session(session) as session:
     #         stmt = select(User).filter(User.user_id == user_id)
     #         await session.execute(stmt)
     #         await session.commit()
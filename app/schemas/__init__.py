@@ -2,7 +2,7 @@ from typing import Annotated
 from datetime import datetime
 from uuid import UUID
 
-from pydantic import BaseModel, Field, field_validator
+from pydantic import BaseModel, ConfigDict, Field, field_validator
 
 
 # Device
@@ -31,6 +31,52 @@ class ThermostatReport(BaseModel):
     timestamp: datetime
 
 
+class ReportInDB(BaseModel):
+    model_config = ConfigDict(from_attributes=True)
+
+    report_id: UUID
+    user_id: UUID
+    device_id: UUID
+    temperature_celcius: float
+    heater_on: bool
+    timestamp: datetime
+
+
+class DeviceLatest(BaseModel):
+    model_config = ConfigDict(from_attributes=True)
+
+    temperature_celcius: float
+    heater_on: bool
+    timestamp: datetime
+    received_at: datetime | None = None
+
+
+class ReportPage(BaseModel):
+    reports: list[ReportInDB]
+    next_cursor: str | None  # pass back as `cursor` to get the next page
+
+
+class ReportBucket(BaseModel):
+    bucket_start: datetime
+    count: int
+    min_temperature_celcius: float
+    max_temperature_celcius: float
+    avg_temperature_celcius: float
+    heater_on_fraction: float
+
+
+class ReportResult(BaseModel):
+    index: int
+    accepted: bool
+    error: str | None = None
+
+
+class ReportBatchResult(BaseModel):
+    accepted: int
+    rejected: int
+    results: list[ReportResult]
+
+
 class TimeSlot(BaseModel):
     time: Annotated[str, Field(pattern=r"^\d{2}:\d{2}$")]
     temperature: Annotated[int, Field(ge=0, le=40)]
@@ -77,6 +123,7 @@ class ThermostatSchedule(BaseModel):
 class AuthRequest(BaseModel):
     device_id: UUID
     signature: str
+    challenge: str | None = None  # required when challenges are signed
 
 
 class AuthChallenge(BaseModel):
@@ -0,0 +1,10 @@
+from pathlib import Path
+import os
+import sys
+
+# the app imports its modules relative to app/, as it does when run from there
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "app"))
+
+os.environ.setdefault("JWT_SECRET", "test-secret")
+os.environ.setdefault("JWT_ALGO", "HS256")
+os.environ.setdefault("JWT_LENGTH_MINUTES", "30")
@@ -73,6 +73,7 @@ async def test_routes(base_url: str, device_id: str, private_key: RSAPrivateKey)
         auth_request = {
             "device_id": str(device_id),
             "signature": signature_b64,
+            "challenge": challenge,
         }
         response = await client.post(f"{base_url}/auth/device/login", json=auth_request)
         response.raise_for_status()
@@ -0,0 +1,58 @@
+from uuid import uuid4
+import asyncio
+import base64
+
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import padding, rsa
+
+import auth
+from models import Device
+from repositories.challenge_store import MemoryChallengeStore
+from repositories.identity_cache import public_key_cache
+from schemas import AuthRequest
+
+
+def test_device_login_reuses_cached_public_key(monkeypatch):
+    private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    device = Device(
+        device_id=uuid4(),
+        public_key=private_key.public_key()
+        .public_bytes(
+            serialization.Encoding.PEM,
+            serialization.PublicFormat.SubjectPublicKeyInfo,
+        )
+        .decode(),
+    )
+
+    async def get_device_by_id(device_id, session=None):
+        return device
+
+    store = MemoryChallengeStore(ttl_s=300, sweep_interval_s=30)
+    monkeypatch.setattr(
+        auth.DeviceRepository, "get_device_by_id", staticmethod(get_device_by_id)
+    )
+    monkeypatch.setattr(auth, "challenge_store", store)
+    public_key_cache.clear()
+
+    async def login():
+        challenge = (await store.issue(device.device_id)).challenge
+        signature = private_key.sign(
+            challenge.encode(),
+            padding.PSS(
+                mgf=padding.MGF1(hashes.SHA256()),
+                salt_length=padding.PSS.MAX_LENGTH,
+            ),
+            hashes.SHA256(),
+        )
+        return await auth.authenticate_device(
+            AuthRequest(
+                device_id=device.device_id,
+                signature=base64.b64encode(signature).decode(),
+            )
+        )
+
+    hits = public_key_cache.hits
+    assert asyncio.run(login()) is device
+    assert public_key_cache.hits == hits
+    assert asyncio.run(login()) is device
+    assert public_key_cache.hits == hits + 1
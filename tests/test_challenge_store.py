@@ -0,0 +1,52 @@
+from uuid import uuid4
+import asyncio
+
+import pytest
+
+fakeredis = pytest.importorskip("fakeredis")
+
+from repositories import challenge_store
+from repositories.challenge_store import RedisChallengeStore
+
+
+@pytest.fixture
+def store(monkeypatch):
+    async def device_exists(device_id, session):
+        return True
+
+    monkeypatch.setattr(
+        challenge_store.ChallengeStore,
+        "_device_exists",
+        staticmethod(device_exists),
+    )
+    return RedisChallengeStore(
+        ttl_s=300, url="redis://unused", client=fakeredis.FakeAsyncRedis()
+    )
+
+
+def test_redis_store_issue_get_delete(store):
+    device_id = uuid4()
+
+    async def run():
+        issued = await store.issue(device_id)
+        assert (await store.issue(device_id)).challenge == issued.challenge
+        fetched = await store.get(device_id)
+        assert fetched.challenge == issued.challenge
+        assert fetched.expires_at == issued.expires_at
+        await store.delete(device_id)
+        assert await store.get(device_id) is None
+        assert (await store.issue(device_id)).challenge != issued.challenge
+        await store.stop()
+
+    asyncio.run(run())
+
+
+def test_redis_store_concurrent_issue_returns_one_challenge(store):
+    device_id = uuid4()
+
+    async def run():
+        challenges = await asyncio.gather(*(store.issue(device_id) for _ in range(10)))
+        await store.stop()
+        return {challenge.challenge for challenge in challenges}
+
+    assert len(asyncio.run(run())) == 1
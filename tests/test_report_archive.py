@@ -0,0 +1,149 @@
+from datetime import datetime
+from types import SimpleNamespace
+from uuid import uuid4
+import asyncio
+
+import pytest
+
+pytest.importorskip("pyarrow")
+
+from models import Report
+from repositories import report_repository
+from repositories.report_archive import ReportArchive
+from repositories.report_repository import ReportRepository
+
+
+def _report(device_id, user_id, timestamp, temperature, heater_on=False):
+    return Report(
+        report_id=uuid4(),
+        user_id=user_id,
+        device_id=device_id,
+        temperature_celcius=temperature,
+        heater_on=heater_on,
+        timestamp=timestamp,
+    )
+
+
+@pytest.fixture
+def archive(tmp_path, monkeypatch):
+    archive = ReportArchive(str(tmp_path), hot_days=0, interval_s=3600)
+    monkeypatch.setattr(report_repository, "report_archive", archive)
+    return archive
+
+
+def test_user_months_cover_every_device_in_order(archive):
+    user_id, other_user = uuid4(), uuid4()
+    first, second = uuid4(), uuid4()
+    archive._merge_into_file(
+        first,
+        datetime(2024, 1, 1),
+        [
+            _report(first, user_id, datetime(2024, 1, 3), 20),
+            _report(first, other_user, datetime(2024, 1, 4), 21),
+        ],
+    )
+    archive._merge_into_file(
+        second,
+        datetime(2024, 1, 1),
+        [_report(second, user_id, datetime(2024, 1, 2), 22)],
+    )
+    archive._merge_into_file(
+        second,
+        datetime(2024, 2, 1),
+        [_report(second, user_id, datetime(2024, 2, 1), 23)],
+    )
+
+    async def collect():
+        return [month async for month in archive.iter_user_months(user_id)]
+
+    months = asyncio.run(collect())
+    assert [[r.temperature_celcius for r in month] for month in months] == [
+        [22, 20],
+        [23],
+    ]
+    assert months[0][0].device_id == second
+
+
+def test_latest_reads_newest_archived_month(archive):
+    device_id = uuid4()
+    for month, day in ((1, 5), (3, 7)):
+        archive._merge_into_file(
+            device_id,
+            datetime(2024, month, 1),
+            [
+                _report(device_id, None, datetime(2024, month, day), day),
+                _report(device_id, None, datetime(2024, month, 2), 0),
+            ],
+        )
+
+    latest = asyncio.run(archive.latest(device_id))
+    assert latest.timestamp == datetime(2024, 3, 7)
+    assert asyncio.run(archive.latest(uuid4())) is None
+
+
+def test_unaligned_aggregates_merge_archived_buckets(archive):
+    device_id = uuid4()
+    archive._merge_into_file(
+        device_id,
+        datetime(2024, 1, 1),
+        [
+            _report(device_id, None, datetime(2024, 1, 1, 10, 1), 18, True),
+            _report(device_id, None, datetime(2024, 1, 1, 10, 4), 22),
+            _report(device_id, None, datetime(2024, 1, 1, 10, 7), 30),
+        ],
+    )
+    # a late report for the same bucket that is still in the report table
+    hot = SimpleNamespace(
+        bucket_start=datetime(2024, 1, 1, 10, 5),
+        count=1,
+        min_temperature_celcius=10.0,
+        max_temperature_celcius=10.0,
+        avg_temperature_celcius=10.0,
+        heater_on_fraction=1.0,
+    )
+
+    buckets = asyncio.run(
+        ReportRepository._merge_archived_buckets(
+            [hot], device_id, "5m", datetime(2024, 1, 1, 10, 1), None
+        )
+    )
+    assert buckets == [
+        {
+            "bucket_start": datetime(2024, 1, 1, 10, 0),
+            "count": 2,
+            "min_temperature_celcius": 18,
+            "max_temperature_celcius": 22,
+            "avg_temperature_celcius": 20,
+            "heater_on_fraction": 0.5,
+        },
+        {
+            "bucket_start": datetime(2024, 1, 1, 10, 5),
+            "count": 2,
+            "min_temperature_celcius": 10.0,
+            "max_temperature_celcius": 30,
+            "avg_temperature_celcius": 20,
+            "heater_on_fraction": 0.5,
+        },
+    ]
+
+
+def test_cursor_skips_months_before_it(archive, monkeypatch):
+    device_id = uuid4()
+    reports = [
+        _report(device_id, None, datetime(2024, month, 2), month) for month in (1, 2, 3)
+    ]
+    for report in reports:
+        archive._merge_into_file(device_id, report.timestamp.replace(day=1), [report])
+    read = []
+    read_month = archive._read_month
+    monkeypatch.setattr(
+        archive,
+        "_read_month",
+        lambda path, *args, **kwargs: read.append(path.stem)
+        or read_month(path, *args, **kwargs),
+    )
+
+    cursor = (reports[1].timestamp, reports[1].report_id)
+    page = asyncio.run(archive.read(device_id, after=cursor))
+    assert [report.temperature_celcius for report in page] == [3]
+    assert read == ["2024-02", "2024-03"]